@@ -0,0 +1,45 @@
+# Общее для бенчмарков: синтетический каталог и перцентили.
+# Без import main — годится и для генератора нагрузки.
+import random
+import statistics
+
+WORDS = (
+    "cheat menu aimbot esp wallhack speed hack mod apk launcher injector "
+    "minecraft roblox cs2 dota valorant pubg fortnite gta rust tarkov "
+    "free premium crack patch update full version windows android ios"
+).split()
+
+
+def make_rows(n: int, seed: int = 1) -> list[dict]:
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        name = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 4)))
+        caption = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(0, 12)))
+        rows.append({
+            "code": f"{i:08x}",
+            "file_id": "BQACAgIAAxkBAAI" + "x" * 60,
+            "type": "document",
+            "name": f"{name} v{rnd.randint(1, 20)}.zip",
+            "caption": caption,
+            "downloads": rnd.randint(0, 5000),
+            "uploaded_by": rnd.randint(1, 50),
+            "uploader_role": rnd.randint(1, 3),
+            "uploader_name": f"@admin{rnd.randint(1, 50)}",
+            "created_at": "2025-01-01T00:00:00.000000+00:00",
+        })
+    return rows
+
+
+def percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))]
+    return {
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p95_ms": round(pick(0.95) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+    }
@@ -0,0 +1,335 @@
+# Стоимость хендлеров целиком: синтетические Update идут через dp.feed_update
+# с поддельной сессией Bot API (без сети, но с настоящей сериализацией и
+# разбором ответа) и SQLite-хранилищем, обёрнутым в счётчик вызовов.
+#
+# Сценарии: cmd_start (/start <code> от подписчика), cmd_start_admin (панель),
+# save_file_handler (админ шлёт документ), cmd_find, do_broadcast (до старта
+# задания; доставка меряется отдельно).
+#
+# Для каждого размера «файлы:пользователи» — отдельный процесс с чистыми кэшами.
+# Отчёт: p50/p95/p99, вызовы хранилища и Bot API на апдейт, аллокации на апдейт.
+#
+#   python bench/handler_bench.py --sizes 1000:1000 10000:10000 100000:100000 --out before.json
+#   python bench/handler_bench.py --out after.json --compare before.json
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from collections import Counter
+
+from common import WORDS, make_rows, percentiles
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("OWNER_ID", "1")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("CHANNEL_ID", "-100500")
+os.environ.setdefault("FILE_DISK_CACHE", "")
+os.environ.setdefault("BROADCAST_RATE", "1000000")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+
+OWNER_ID = int(os.environ["OWNER_ID"])
+ADMIN_ID = 2
+
+
+# ── подделки ──
+class CountingStorage:
+    def __init__(self, inner, latency: float = 0.0):
+        self.inner = inner
+        self.latency = latency
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if name.startswith("_") or not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            self.calls[name] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return await attr(*args, **kwargs)
+
+        setattr(self, name, call)
+        return call
+
+
+def make_session_class():
+    from aiogram.client.session.base import BaseSession
+
+    class FakeSession(BaseSession):
+        def __init__(self, latency: float = 0.0):
+            super().__init__()
+            self.latency = latency
+            self.calls = Counter()
+            self._message_id = 0
+
+        def _result(self, name: str, payload: dict):
+            if name == "getChatMember":
+                return {"status": "member", "user": {"id": payload.get("user_id", 1), "is_bot": False, "first_name": "u"}}
+            if name == "copyMessage":
+                self._message_id += 1
+                return {"message_id": self._message_id}
+            if name.startswith("send") or name.startswith("edit"):
+                self._message_id += 1
+                chat_id = payload.get("chat_id", 1)
+                return {
+                    "message_id": self._message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": "ok",
+                }
+            return True
+
+        async def make_request(self, bot, method, timeout=None):
+            name = method.__api_method__
+            self.calls[name] += 1
+            files = {}
+            payload = {}
+            # Как AiohttpSession.build_form_data — сериализация входит в замер
+            for key, value in method.model_dump(warnings=False).items():
+                value = self.prepare_value(value, bot=bot, files=files)
+                if value:
+                    payload[key] = value
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            content = json.dumps({"ok": True, "result": self._result(name, payload)})
+            return self.check_response(bot=bot, method=method, status_code=200, content=content).result
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+    return FakeSession
+
+
+# ── апдейты ──
+class Updates:
+    def __init__(self, users: int, codes: list[str], seed: int = 7):
+        self.rnd = random.Random(seed)
+        self.users = users
+        self.codes = codes
+        self.update_id = 0
+        self.message_id = 0
+
+    def _message(self, uid: int, **fields) -> dict:
+        self.update_id += 1
+        self.message_id += 1
+        return {
+            "update_id": self.update_id,
+            "message": {
+                "message_id": self.message_id, "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"u{uid}"},
+                **fields,
+            },
+        }
+
+    def subscriber(self) -> int:
+        return self.rnd.randint(12, max(12, self.users))
+
+    def hot_code(self) -> str:
+        # Популярность ссылок — длинный хвост: немного кодов забирают большую часть трафика
+        idx = min(len(self.codes) - 1, int(self.rnd.paretovariate(1.2)) - 1)
+        return self.codes[idx]
+
+    def cmd_start(self) -> dict:
+        return self._message(self.subscriber(), text=f"/start {self.hot_code()}")
+
+    def cmd_start_admin(self) -> dict:
+        return self._message(ADMIN_ID, text="/start")
+
+    def save_file_handler(self) -> dict:
+        n = self.rnd.randint(0, 10 ** 9)
+        return self._message(ADMIN_ID, caption="bench upload", document={
+            "file_id": f"BQACAgIAAxkBAAI{n:x}", "file_unique_id": f"u{n:x}", "file_name": f"bench {n}.zip",
+        })
+
+    def cmd_find(self) -> dict:
+        word = self.rnd.choice(WORDS)
+        return self._message(ADMIN_ID, text=f"/find {word[:self.rnd.randint(2, 6)]}")
+
+    def do_broadcast(self) -> dict:
+        return self._message(OWNER_ID, text="bench broadcast")
+
+
+SCENARIOS = ("cmd_start", "cmd_start_admin", "save_file_handler", "cmd_find", "do_broadcast")
+
+
+# ── один размер, в отдельном процессе ──
+async def run_size(files: int, users: int, args) -> dict:
+    import main
+    from aiogram import types
+    from storage_bench import seed
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CountingStorage(main.SQLiteStorage(os.path.join(tmp, "bench.sqlite3")), args.storage_latency_ms / 1000)
+        main.storage = store
+        session = make_session_class()(args.api_latency_ms / 1000)
+        main.bot.session = session
+        await store.start()
+        try:
+            rows = make_rows(files)
+            await seed(store.inner, rows, users)
+            await main.load_roles()
+            await main.load_bans()
+            await main.load_search_index()
+
+            gen = Updates(users, [row["code"] for row in rows])
+            result = {}
+            for name in SCENARIOS:
+                count = args.broadcasts if name == "do_broadcast" else args.updates
+                result[name] = await run_scenario(main, types, store, session, gen, name, count, args.alloc_updates)
+                if name == "do_broadcast":
+                    result[name]["delivery"] = await wait_broadcasts(main)
+
+            t = time.perf_counter()
+            before = sum(store.calls.values())
+            await main.flush_users()
+            await main.flush_downloads()
+            result["flush"] = {
+                "storage_calls": sum(store.calls.values()) - before,
+                "ms": round((time.perf_counter() - t) * 1000, 3),
+            }
+            return result
+        finally:
+            await store.close()
+
+
+async def run_scenario(main, types, store, session, gen, name, count, alloc_updates) -> dict:
+    make = getattr(gen, name)
+
+    async def feed(raw: dict):
+        if name == "do_broadcast":
+            ctx = main.dp.fsm.get_context(main.bot, chat_id=OWNER_ID, user_id=OWNER_ID)
+            await ctx.set_state(main.BroadcastState.waiting_message)
+        update = types.Update.model_validate(raw, context={"bot": main.bot})
+        await main.dp.feed_update(main.bot, update)
+
+    times, storage_calls, api_calls = [], [], []
+    for _ in range(count):
+        raw = make()
+        s0, a0 = sum(store.calls.values()), sum(session.calls.values())
+        t = time.perf_counter()
+        await feed(raw)
+        times.append(time.perf_counter() - t)
+        storage_calls.append(sum(store.calls.values()) - s0)
+        api_calls.append(sum(session.calls.values()) - a0)
+
+    # Аллокации — отдельным проходом: tracemalloc сильно замедляет и исказил бы задержки
+    peaks, retained = [], []
+    tracemalloc.start()
+    for _ in range(min(alloc_updates, count)):
+        raw = make()
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        await feed(raw)
+        current, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - start)
+        retained.append(current - start)
+    tracemalloc.stop()
+
+    result = percentiles(times)
+    result.update({
+        "updates": count,
+        "storage_calls_per_update": round(sum(storage_calls) / count, 3),
+        "storage_calls_max": max(storage_calls),
+        "api_calls_per_update": round(sum(api_calls) / count, 3),
+        "alloc_peak_kb": round(sum(peaks) / len(peaks) / 1024, 1) if peaks else None,
+        "alloc_retained_kb": round(sum(retained) / len(retained) / 1024, 2) if retained else None,
+    })
+    return result
+
+
+async def wait_broadcasts(main) -> dict:
+    t = time.perf_counter()
+    jobs = list(main.broadcast_jobs.values())
+    await asyncio.gather(*main.broadcast_tasks.values(), return_exceptions=True)
+    return {
+        "jobs": len(jobs),
+        "sent": sum(job.sent for job in jobs),
+        "wait_s": round(time.perf_counter() - t, 3),
+    }
+
+
+# ── отчёт ──
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, text=True, stderr=subprocess.DEVNULL,
+        ).strip()
+    except Exception:
+        return None
+
+
+def compare(report: dict, baseline: dict):
+    for size, scenarios in report["sizes"].items():
+        base = baseline.get("sizes", {}).get(size)
+        if not base:
+            continue
+        for name, entry in scenarios.items():
+            old = base.get(name)
+            if not old or "p50_ms" not in entry or "p50_ms" not in old:
+                continue
+            ratio = lambda key: entry[key] / old[key] if old[key] else float("nan")
+            print(
+                f"{size:>15} {name:<18} p50 {old['p50_ms']:>8} → {entry['p50_ms']:<8} ({ratio('p50_ms'):.2f}x)"
+                f"  p99 {old['p99_ms']:>8} → {entry['p99_ms']:<8} ({ratio('p99_ms'):.2f}x)"
+                f"  storage/upd {old['storage_calls_per_update']} → {entry['storage_calls_per_update']}"
+            )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", default=["1000:1000", "10000:10000", "100000:100000"],
+                        help="файлы:пользователи")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--broadcasts", type=int, default=3)
+    parser.add_argument("--alloc-updates", type=int, default=200)
+    parser.add_argument("--storage-latency-ms", type=float, default=0)
+    parser.add_argument("--api-latency-ms", type=float, default=0)
+    parser.add_argument("--out", default="handler_bench.json")
+    parser.add_argument("--compare")
+    parser.add_argument("--one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        import logging
+        logging.basicConfig(level=logging.CRITICAL)
+        files, users = map(int, args.one.split(":"))
+        print(json.dumps(asyncio.run(run_size(files, users, args))))
+        return
+
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "params": {k: v for k, v in vars(args).items() if k not in ("one", "out", "compare")},
+        "sizes": {},
+    }
+    for size in args.sizes:
+        cmd = [sys.executable, os.path.abspath(__file__), "--one", size]
+        for key in ("updates", "broadcasts", "alloc_updates", "storage_latency_ms", "api_latency_ms"):
+            cmd += [f"--{key.replace('_', '-')}", str(getattr(args, key))]
+        out = subprocess.check_output(cmd, text=True)
+        report["sizes"][size] = json.loads(out.strip().splitlines()[-1])
+        for name, entry in report["sizes"][size].items():
+            print(f"{size:>15} {name:<18} {json.dumps(entry)}", flush=True)
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"saved: {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main_cli()
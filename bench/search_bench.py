@@ -0,0 +1,101 @@
+# Сравнение вариантов /find на синтетическом каталоге:
+#   scan   — старый путь: весь files JSON (как от db_all) + поиск подстроки в Python
+#   index  — SearchIndex из main.py
+#   server — поиск в хранилище: RPC search_files или SQL при STORAGE_BACKEND=sqlite
+#            (только с --server; каталог должен быть уже в базе)
+#
+#   python bench/search_bench.py --sizes 10000 100000
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("OWNER_ID", "1")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:1")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+
+import main  # noqa: E402
+from common import WORDS, make_rows, percentiles  # noqa: E402
+
+
+def bench_scan(payload: bytes, queries: list[str]) -> dict:
+    times = []
+    for q in queries:
+        t = time.perf_counter()
+        rows = json.loads(payload)
+        [e for e in rows if q in (e.get("name") or "").lower() or q in (e.get("caption") or "").lower()]
+        times.append(time.perf_counter() - t)
+    return percentiles(times)
+
+
+def bench_index(rows: list[dict], queries: list[str]) -> dict:
+    tracemalloc.start()
+    t = time.perf_counter()
+    index = main.SearchIndex()
+    for row in rows:
+        index.add(row, loading=True)
+    index.finish_loading()
+    build = time.perf_counter() - t
+    mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    times = []
+    for q in queries:
+        t = time.perf_counter()
+        index.search(q, main.SEARCH_LIMIT)
+        times.append(time.perf_counter() - t)
+    result = percentiles(times)
+    result["build_s"] = round(build, 3)
+    result["memory_mb"] = round(mem / 2 ** 20, 1)
+    return result
+
+
+async def bench_server(queries: list[str]) -> dict:
+    await main.storage.start()
+    try:
+        times = []
+        for q in queries:
+            t = time.perf_counter()
+            await main.search_files_remote(q, main.SEARCH_LIMIT)
+            times.append(time.perf_counter() - t)
+        return percentiles(times)
+    finally:
+        await main.storage.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--server", action="store_true")
+    args = parser.parse_args()
+
+    rnd = random.Random(2)
+    queries = [rnd.choice(WORDS)[:rnd.randint(2, 6)] for _ in range(args.queries)]
+    queries += ["nothing-like-this"] * (args.queries // 10)
+
+    report = {}
+    for n in args.sizes:
+        rows = make_rows(n)
+        payload = json.dumps(rows).encode()
+        entry = {
+            "payload_mb": round(len(payload) / 2 ** 20, 1),
+            "scan": bench_scan(payload, queries),
+            "index": bench_index(rows, queries),
+        }
+        if args.server:
+            entry["server"] = asyncio.run(bench_server(queries))
+        report[n] = entry
+        print(f"{n} files: {json.dumps(entry)}", flush=True)
+    return report
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,130 @@
+# Задержки горячих путей хранилища, без кэшей main.py:
+#   get_file, get_admin, is_banned  — /start <code> и проверки роли/бана
+#   upsert_users                    — сброс буфера пользователей (пачка)
+#   increment_downloads             — сброс буфера скачиваний (пачка)
+#   files_page                      — /list и /myfiles
+#
+# sqlite   — всегда, во временном файле, на синтетических данных
+# supabase — только с --supabase и настоящими SUPABASE_URL/SUPABASE_KEY;
+#            замеры только на чтение, кроме --supabase-writes
+#
+#   python bench/storage_bench.py --files 10000 --users 100000
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("OWNER_ID", "1")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:1")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+
+import main  # noqa: E402
+from common import make_rows, percentiles  # noqa: E402
+
+
+async def seed(store: main.Storage, files: list[dict], users: int):
+    for row in files:
+        await store.insert_file(row)
+    batch = []
+    for uid in range(1, users + 1):
+        batch.append({"user_id": uid, "username": f"u{uid}", "first_name": "x", "active": True})
+        if len(batch) == 1000:
+            await store.upsert_users(batch)
+            batch = []
+    if batch:
+        await store.upsert_users(batch)
+    for uid in range(2, 12):
+        await store.insert_admin(uid, 1 + uid % 3, f"@admin{uid}")
+    for uid in range(1000, 1100):
+        await store.add_ban(uid, "bench", 1)
+
+
+async def timed(fn, args_list) -> dict:
+    times = []
+    for args in args_list:
+        t = time.perf_counter()
+        await fn(*args)
+        times.append(time.perf_counter() - t)
+    return percentiles(times)
+
+
+async def bench(store: main.Storage, codes: list[str], users: int, n: int, writes: bool) -> dict:
+    rnd = random.Random(3)
+    pick_code = lambda: rnd.choice(codes) if rnd.random() < 0.9 else "missing0"
+    result = {
+        "get_file": await timed(store.get_file, [(pick_code(),) for _ in range(n)]),
+        "get_admin": await timed(store.get_admin, [(rnd.randint(1, 20),) for _ in range(n)]),
+        "is_banned": await timed(store.is_banned, [(rnd.randint(1, users),) for _ in range(n)]),
+        "files_page": await timed(
+            store.files_page, [(None, None, False, main.FILE_PAGE_SIZE + 1) for _ in range(n // 4)]
+        ),
+        "files_page_uploader": await timed(
+            store.files_page, [(rnd.randint(1, 50), None, False, main.FILE_PAGE_SIZE + 1) for _ in range(n // 4)]
+        ),
+    }
+    if writes:
+        result["upsert_users_x100"] = await timed(store.upsert_users, [
+            ([{"user_id": rnd.randint(1, users), "username": "u", "first_name": "y", "active": True}
+              for _ in range(100)],)
+            for _ in range(n // 10)
+        ])
+        result["increment_downloads_x50"] = await timed(store.increment_downloads, [
+            ({rnd.choice(codes): rnd.randint(1, 5) for _ in range(50)},)
+            for _ in range(n // 10)
+        ])
+    return result
+
+
+async def run_sqlite(args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        store = main.SQLiteStorage(os.path.join(tmp, "bench.sqlite3"))
+        await store.start()
+        try:
+            files = make_rows(args.files)
+            t = time.perf_counter()
+            await seed(store, files, args.users)
+            seeded = time.perf_counter() - t
+            result = await bench(store, [row["code"] for row in files], args.users, args.ops, True)
+            result["seed_s"] = round(seeded, 2)
+            return result
+        finally:
+            await store.close()
+
+
+async def run_supabase(args) -> dict:
+    store = main.SupabaseStorage(main.http)
+    await store.start()
+    try:
+        codes = [row["code"] for row in await store.scan_files("", 1000)]
+        users = await store.count_users() or 1
+        return await bench(store, codes or ["missing0"], users, args.ops, args.supabase_writes)
+    finally:
+        await store.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--supabase", action="store_true")
+    parser.add_argument("--supabase-writes", action="store_true")
+    args = parser.parse_args()
+
+    report = {"sqlite": asyncio.run(run_sqlite(args))}
+    if args.supabase:
+        report["supabase"] = asyncio.run(run_supabase(args))
+    for backend, entry in report.items():
+        print(f"{backend}: {json.dumps(entry)}", flush=True)
+    return report
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,620 @@
+# Нагрузочный прогон настоящего main(): aiohttp-приложение с SimpleRequestHandler
+# на WH_PATH получает вебхуки так же, как от Telegram.
+#
+# Рядом поднимаются две заглушки (отдельным процессом, чтобы не делить CPU с ботом
+# и генератором нагрузки):
+#   Bot API   — отвечает на любой метод, задержка --api-latency-ms
+#   PostgREST — таблицы и RPC main.py в памяти, задержка --db-latency-ms
+#
+# SimpleRequestHandler по умолчанию отвечает Telegram сразу и обрабатывает апдейт
+# в фоне, поэтому кроме времени ответа вебхука меряется и время до ответа
+# пользователю: от POST вебхука до первого send*/copy*/edit* в этот чат.
+#
+# Сценарии:
+#   viral — тысячи /start <code> в минуту на один код от разных пользователей
+#   mixed — /start по популярным ссылкам, панель админа, /find, произвольный текст
+#
+#   python bench/webhook_load.py --scenario viral --rate 100 --duration 30
+#   python bench/webhook_load.py --scenario mixed --rate 200 --db-latency-ms 40 --out load.json
+#   python bench/webhook_load.py --scenario mixed --rate 600 --workers 4
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import subprocess
+from collections import Counter
+
+from aiohttp import web, ClientSession, TCPConnector, ClientTimeout
+
+from common import percentiles
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, "..")
+TOKEN = "123456:load"
+OWNER_ID = 1
+ADMIN_ID = 2
+VIRAL_CODE = "00000000"
+
+WORDS = (
+    "cheat menu aimbot esp wallhack speed hack mod apk launcher injector "
+    "minecraft roblox cs2 dota valorant pubg fortnite gta rust tarkov"
+).split()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ══════════════════════════════════════════════
+#  ЗАГЛУШКА BOT API
+# ══════════════════════════════════════════════
+def fake_bot_api(latency: float) -> web.Application:
+    calls = Counter()
+    replies: dict[str, list[float]] = {}
+    message_id = 0
+
+    async def handle(request: web.Request):
+        nonlocal message_id
+        method = request.match_info["method"]
+        calls[method] += 1
+        form = await request.post()
+        if latency:
+            await asyncio.sleep(latency)
+        if method.startswith(("send", "copy", "edit")):
+            replies.setdefault(form.get("chat_id", ""), []).append(time.time())
+        if method == "getChatMember":
+            user_id = int(form.get("user_id", 1))
+            result = {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "u"}}
+        elif method == "copyMessage":
+            message_id += 1
+            result = {"message_id": message_id}
+        elif method.startswith("send") or method.startswith("edit"):
+            message_id += 1
+            result = {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": int(form.get("chat_id", 1)), "type": "private"}, "text": "ok",
+            }
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(_r):
+        return web.json_response(dict(calls))
+
+    async def get_replies(_r):
+        return web.json_response(replies)
+
+    app = web.Application(client_max_size=2 ** 24)
+    app.router.add_get("/_stats", stats)
+    app.router.add_get("/_replies", get_replies)
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+# ══════════════════════════════════════════════
+#  ЗАГЛУШКА POSTGREST
+# ══════════════════════════════════════════════
+PRIMARY_KEYS = {
+    "files": ("code",),
+    "users": ("user_id",),
+    "admins": ("user_id",),
+    "bans": ("user_id",),
+    "channels": ("chat_id",),
+    "broadcast_jobs": ("id",),
+    "broadcast_recipients": ("job_id", "user_id"),
+    "bot_settings": ("name",),
+    "fsm_states": ("key",),
+}
+# Текстовые первичные ключи — для приведения типов, пока таблица пуста
+TEXT_KEYS = {"code", "key"}
+JOB_DEFAULTS = {"status": "running", "cursor": 0, "total": 0, "sent": 0, "failed": 0, "blocked": 0}
+SPECIAL_PARAMS = {"select", "order", "limit", "on_conflict", "or"}
+
+
+def _coerce(value: str, sample):
+    if isinstance(sample, bool):
+        return value == "true"
+    if isinstance(sample, int):
+        return int(value)
+    if isinstance(sample, float):
+        return float(value)
+    return value
+
+
+# listed — условие внутри in.() или or=(): только там PostgREST снимает кавычки
+def _match(row: dict, col: str, expr: str, listed: bool = False) -> bool:
+    op, _, value = expr.partition(".")
+    if listed:
+        value = value.strip('"')
+    current = row.get(col)
+    if op == "is":
+        return current is (value == "true") if value in ("true", "false") else current is None
+    if op == "in":
+        items = value.strip("()").split(",")
+        return any(current == _coerce(item.strip('"'), current) for item in items)
+    if current is None:
+        return False
+    value = _coerce(value, current)
+    if op == "eq":
+        return current == value
+    if op == "gt":
+        return current > value
+    if op == "lt":
+        return current < value
+    raise ValueError(f"unsupported operator {op}")
+
+
+def _split_top(text: str) -> list[str]:
+    parts, depth, start, quoted = [], 0, 0, False
+    for i, ch in enumerate(text):
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == "(":
+            depth += 1
+        elif not quoted and ch == ")":
+            depth -= 1
+        elif not quoted and ch == "," and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+# or=(a.op.v,and(b.op.v,c.op.v))
+def _match_logic(row: dict, kind: str, body: str) -> bool:
+    results = []
+    for part in _split_top(body):
+        if part.startswith("and(") or part.startswith("or("):
+            sub_kind, _, rest = part.partition("(")
+            results.append(_match_logic(row, sub_kind, rest[:-1]))
+        else:
+            col, _, expr = part.partition(".")
+            results.append(_match(row, col, expr, listed=True))
+    return all(results) if kind == "and" else any(results)
+
+
+class FakePostgrest:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.tables: dict[str, dict] = {name: {} for name in PRIMARY_KEYS}
+        self.calls = Counter()
+        self.next_job_id = 1
+
+    def seed(self, files: int, users: int):
+        rnd = random.Random(1)
+        for i in range(files):
+            code = f"{i:08x}"
+            self.tables["files"][(code,)] = {
+                "code": code, "file_id": f"BQACAgIAAxkBAAI{i:x}", "type": "document",
+                "name": " ".join(rnd.choice(WORDS) for _ in range(3)) + ".zip",
+                "caption": " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(0, 8))),
+                "downloads": rnd.randint(0, 5000), "uploaded_by": rnd.randint(2, 11),
+                "uploader_role": 1, "uploader_name": f"@admin{rnd.randint(2, 11)}",
+                "created_at": f"2025-01-01T00:00:{i % 60:02d}.{i:06d}+00:00",
+            }
+        for uid in range(100, 100 + users):
+            self.tables["users"][(uid,)] = {"user_id": uid, "username": f"u{uid}", "first_name": "u", "active": True}
+        for uid in range(2, 12):
+            self.tables["admins"][(uid,)] = {"user_id": uid, "role": 1 + uid % 3, "username": f"@admin{uid}"}
+
+    def _key(self, table: str, row: dict) -> tuple:
+        return tuple(row[col] for col in PRIMARY_KEYS[table])
+
+    def _select(self, table: str, params) -> list[dict]:
+        filters = [(k, v) for k, v in params.items() if k not in SPECIAL_PARAMS]
+        pk = PRIMARY_KEYS[table]
+        # Быстрый путь: выборка по первичному ключу
+        if len(pk) == 1 and len(filters) == 1 and filters[0][0] == pk[0] and filters[0][1].startswith("eq."):
+            sample = next(iter(self.tables[table].values()), {}).get(pk[0], "" if pk[0] in TEXT_KEYS else 0)
+            row = self.tables[table].get((_coerce(filters[0][1][3:], sample),))
+            return [row] if row else []
+        rows = [
+            row for row in self.tables[table].values()
+            if all(_match(row, col, expr) for col, expr in filters)
+        ]
+        if "or" in params:
+            body = params["or"]
+            rows = [row for row in rows if _match_logic(row, "or", body[1:-1])]
+        for part in reversed(params.get("order", "").split(",") if params.get("order") else []):
+            col, _, direction = part.partition(".")
+            rows.sort(key=lambda r: (r.get(col) is None, r.get(col)), reverse=direction.startswith("desc"))
+        if "limit" in params:
+            rows = rows[:int(params["limit"])]
+        return rows
+
+    @staticmethod
+    def _project(rows: list[dict], params) -> list[dict]:
+        select = params.get("select", "*")
+        if select == "*":
+            return rows
+        cols = select.split(",")
+        return [{col: row.get(col) for col in cols} for row in rows]
+
+    async def table(self, request: web.Request):
+        table = request.match_info["table"]
+        method = request.method
+        self.calls[f"{method} {table}"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request.query
+        prefer = request.headers.get("Prefer", "")
+        if table not in self.tables:
+            return web.json_response({"message": "no table"}, status=404)
+        store = self.tables[table]
+
+        if method == "GET":
+            rows = self._select(table, params)
+            headers = {}
+            if "count=exact" in prefer:
+                headers["Content-Range"] = f"0-{max(0, len(rows) - 1)}/{len(rows)}"
+            return web.json_response(self._project(rows, params), headers=headers)
+
+        if method == "POST":
+            body = await request.json()
+            rows = body if isinstance(body, list) else [body]
+            created = []
+            for row in rows:
+                row = dict(row)
+                if table == "broadcast_jobs":
+                    row = {**JOB_DEFAULTS, **row, "id": self.next_job_id,
+                           "created_at": time.strftime("%Y-%m-%dT%H:%M:%S+00:00")}
+                    self.next_job_id += 1
+                if table == "files":
+                    row.setdefault("created_at", time.strftime("%Y-%m-%dT%H:%M:%S.000000+00:00"))
+                key = self._key(table, row)
+                if key in store:
+                    if "merge-duplicates" not in prefer:
+                        return web.json_response({"message": "duplicate key"}, status=409)
+                    store[key].update(row)
+                else:
+                    store[key] = row
+                created.append(store[key])
+            if "return=representation" in prefer:
+                return web.json_response(created, status=201)
+            return web.Response(status=201)
+
+        if method == "PATCH":
+            body = await request.json()
+            rows = self._select(table, params)
+            for row in rows:
+                row.update(body)
+            if "return=representation" in prefer:
+                return web.json_response(rows)
+            return web.Response(status=204)
+
+        if method == "DELETE":
+            for row in self._select(table, params):
+                store.pop(self._key(table, row), None)
+            return web.Response(status=204)
+        return web.Response(status=405)
+
+    async def rpc(self, request: web.Request):
+        fn = request.match_info["fn"]
+        self.calls[f"RPC {fn}"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        args = await request.json()
+        files = self.tables["files"]
+        if fn == "increment_downloads":
+            for code, delta in zip(args["codes"], args["deltas"]):
+                row = files.get((code,))
+                if row:
+                    row["downloads"] = (row.get("downloads") or 0) + delta
+            return web.Response(status=204)
+        if fn == "search_files":
+            q = args["q"].lower()
+            rows = [
+                row for row in files.values()
+                if q in (row.get("name") or "").lower() or q in (row.get("caption") or "").lower()
+            ]
+            rows.sort(key=lambda r: r.get("downloads") or 0, reverse=True)
+            return web.json_response({"total": len(rows), "rows": rows[:args["lim"]]})
+        if fn == "bot_stats":
+            top = sorted(files.values(), key=lambda r: r.get("downloads") or 0, reverse=True)
+            return web.json_response({
+                "files": len(files),
+                "downloads": sum(row.get("downloads") or 0 for row in files.values()),
+                "users": len(self.tables["users"]),
+                "admins": len(self.tables["admins"]),
+                "top": top[:args.get("top_n", 5)],
+            })
+        if fn == "user_context":
+            uid = args["uid"]
+            return web.json_response({
+                "admin": self.tables["admins"].get((uid,)),
+                "banned": (uid,) in self.tables["bans"],
+            })
+        if fn == "uploader_stats":
+            by = {}
+            for row in files.values():
+                entry = by.setdefault(row["uploaded_by"], {
+                    "uploaded_by": row["uploaded_by"], "uploader_name": row.get("uploader_name"),
+                    "files": 0, "downloads": 0,
+                })
+                entry["files"] += 1
+                entry["downloads"] += row.get("downloads") or 0
+            return web.json_response(sorted(by.values(), key=lambda e: e["files"], reverse=True))
+        return web.json_response({"message": "no function"}, status=404)
+
+    async def stats(self, _r):
+        return web.json_response(dict(self.calls))
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=2 ** 24)
+        app.router.add_get("/_stats", self.stats)
+        app.router.add_post("/rest/v1/rpc/{fn}", self.rpc)
+        app.router.add_route("*", "/rest/v1/{table}", self.table)
+        return app
+
+
+async def serve_fakes(args):
+    db = FakePostgrest(args.db_latency_ms / 1000)
+    db.seed(args.files, args.users)
+    runners = []
+    for app, port in ((fake_bot_api(args.api_latency_ms / 1000), args.api_port), (db.app(), args.db_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+    print("ready", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+# ══════════════════════════════════════════════
+#  ГЕНЕРАТОР НАГРУЗКИ
+# ══════════════════════════════════════════════
+class Updates:
+    def __init__(self, scenario: str, files: int, users: int, seed: int = 5):
+        self.scenario = scenario
+        self.files = files
+        self.users = users
+        self.rnd = random.Random(seed)
+        self.update_id = 0
+        self.new_user = 10 ** 9
+
+    def _message(self, uid: int, text: str) -> dict:
+        self.update_id += 1
+        return {
+            "update_id": self.update_id,
+            "message": {
+                "message_id": self.update_id, "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"u{uid}"},
+                "text": text,
+            },
+        }
+
+    def next(self) -> tuple[str, dict]:
+        if self.scenario == "viral":
+            # Каждый переход по ссылке — новый человек
+            self.new_user += 1
+            return "start_code", self._message(self.new_user, f"/start {VIRAL_CODE}")
+        roll = self.rnd.random()
+        if roll < 0.8:
+            idx = min(self.files - 1, int(self.rnd.paretovariate(1.2)) - 1)
+            uid = self.rnd.randint(100, 100 + self.users)
+            return "start_code", self._message(uid, f"/start {idx:08x}")
+        if roll < 0.9:
+            return "start", self._message(self.rnd.randint(100, 100 + self.users), "/start")
+        if roll < 0.95:
+            return "find", self._message(ADMIN_ID, f"/find {self.rnd.choice(WORDS)[:4]}")
+        return "text", self._message(self.rnd.randint(100, 100 + self.users), "hello")
+
+
+async def wait_http(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as s:
+        while time.monotonic() < deadline:
+            try:
+                async with s.get(url) as r:
+                    if r.status == 200:
+                        return
+            except Exception:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+
+async def fetch_stats(api_url: str, db_url: str) -> dict:
+    async with ClientSession() as s:
+        async with s.get(f"{api_url}/_stats") as r:
+            api = await r.json()
+        async with s.get(f"{db_url}/_stats") as r:
+            db = await r.json()
+    return {"bot_api": api, "postgrest": db}
+
+
+# Ждём, пока бот доделает фоновые апдейты: исходящие запросы перестали расти
+async def wait_quiet(api_url: str, db_url: str, quiet: float = 1.0, timeout: float = 120) -> dict:
+    deadline = time.monotonic() + timeout
+    last = await fetch_stats(api_url, db_url)
+    stable_since = time.monotonic()
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+        current = await fetch_stats(api_url, db_url)
+        if current != last:
+            last, stable_since = current, time.monotonic()
+        elif time.monotonic() - stable_since >= quiet:
+            break
+    return last
+
+
+async def processing_latency(api_url: str, sent_at: dict[str, list[float]]) -> dict:
+    async with ClientSession() as s:
+        async with s.get(f"{api_url}/_replies") as r:
+            replies = await r.json()
+    samples, unanswered = [], 0
+    for chat_id, sends in sent_at.items():
+        answers = sorted(replies.get(chat_id, []))
+        i = 0
+        for t in sends:
+            while i < len(answers) and answers[i] < t:
+                i += 1
+            if i == len(answers):
+                unanswered += 1
+                continue
+            samples.append(answers[i] - t)
+            i += 1
+    result = percentiles(samples)
+    result["unanswered"] = unanswered
+    return result
+
+
+def diff(after: dict, before: dict) -> dict:
+    return {k: v - before.get(k, 0) for k, v in sorted(after.items()) if v - before.get(k, 0)}
+
+
+async def generate_load(args, webhook_url: str) -> dict:
+    updates = Updates(args.scenario, args.files, args.users)
+    total = int(args.rate * args.duration)
+    latencies: dict[str, list[float]] = {}
+    statuses = Counter()
+    lag = []
+    sent_at: dict[str, list[float]] = {}
+
+    async def send(session: ClientSession, kind: str, payload: dict):
+        sent_at.setdefault(str(payload["message"]["chat"]["id"]), []).append(time.time())
+        t = time.perf_counter()
+        try:
+            async with session.post(webhook_url, json=payload) as r:
+                await r.read()
+                statuses[r.status] += 1
+        except Exception as e:
+            statuses[type(e).__name__] += 1
+            return
+        latencies.setdefault(kind, []).append(time.perf_counter() - t)
+
+    connector = TCPConnector(limit=args.concurrency)
+    async with ClientSession(connector=connector, timeout=ClientTimeout(total=120)) as session:
+        tasks = []
+        start = time.perf_counter()
+        # Открытый цикл: запросы уходят по расписанию, не дожидаясь ответов
+        for i in range(total):
+            target = start + i / args.rate
+            delay = target - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lag.append(-delay)
+            kind, payload = updates.next()
+            tasks.append(asyncio.create_task(send(session, kind, payload)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    all_latencies = [x for values in latencies.values() for x in values]
+    return {
+        "requests": total,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(total / elapsed, 1),
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "webhook_ack": percentiles(all_latencies),
+        "latency_by_kind": {kind: percentiles(values) for kind, values in latencies.items()},
+        "generator_lag_max_ms": round(max(lag, default=0) * 1000, 2),
+        "sent_at": sent_at,
+    }
+
+
+async def run(args) -> dict:
+    api_port, db_port, bot_port = free_port(), free_port(), free_port()
+    api_url, db_url = f"http://127.0.0.1:{api_port}", f"http://127.0.0.1:{db_port}"
+
+    fakes = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve-fakes",
+         "--api-port", str(api_port), "--db-port", str(db_port),
+         "--files", str(args.files), "--users", str(args.users),
+         "--api-latency-ms", str(args.api_latency_ms), "--db-latency-ms", str(args.db_latency_ms)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    bot_proc = None
+    try:
+        assert fakes.stdout.readline().strip() == "ready"
+        env = {
+            **os.environ,
+            "BOT_TOKEN": TOKEN, "OWNER_ID": str(OWNER_ID), "BOT_USERNAME": "bench_bot",
+            "PORT": str(bot_port), "RENDER_EXTERNAL_URL": f"http://127.0.0.1:{bot_port}",
+            "TELEGRAM_API_URL": api_url, "SUPABASE_URL": db_url, "SUPABASE_KEY": "load",
+            "STORAGE_BACKEND": "supabase", "CHANNEL_ID": "-100500", "FILE_DISK_CACHE": "",
+            "WORKERS": str(args.workers),
+        }
+        if args.workers > 1:
+            env["FSM_BACKEND"] = "db"
+        bot_proc = subprocess.Popen(
+            [sys.executable, "-c", "import main; main.main()"],
+            cwd=ROOT, env=env,
+            stdout=subprocess.DEVNULL if not args.bot_logs else None,
+            stderr=subprocess.DEVNULL if not args.bot_logs else None,
+        )
+        await wait_http(f"http://127.0.0.1:{bot_port}/health")
+        # on_startup (set_webhook, загрузка ролей и банов) уже прошёл до того, как порт открылся
+        before = await fetch_stats(api_url, db_url)
+        result = await generate_load(args, f"http://127.0.0.1:{bot_port}/wh/{TOKEN}")
+        during = await wait_quiet(api_url, db_url)
+        result["processing"] = await processing_latency(api_url, result.pop("sent_at"))
+
+        bot_proc.send_signal(signal.SIGINT)
+        bot_proc.wait(timeout=30)
+        after = await fetch_stats(api_url, db_url)
+
+        result["outbound"] = {
+            name: diff(during[name], before[name]) for name in during
+        }
+        result["outbound_per_update"] = {
+            name: round(sum(counts.values()) / result["requests"], 3)
+            for name, counts in result["outbound"].items()
+        }
+        result["outbound_on_shutdown"] = {
+            name: diff(after[name], during[name]) for name in after
+        }
+        return result
+    finally:
+        if bot_proc and bot_proc.poll() is None:
+            bot_proc.kill()
+        fakes.terminate()
+        fakes.wait()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", choices=("viral", "mixed"), default="viral")
+    parser.add_argument("--rate", type=float, default=100, help="вебхуков в секунду")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--files", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--api-latency-ms", type=float, default=30)
+    parser.add_argument("--db-latency-ms", type=float, default=20)
+    parser.add_argument("--workers", type=int, default=1, help="WORKERS для бота")
+    parser.add_argument("--bot-logs", action="store_true")
+    parser.add_argument("--out")
+    parser.add_argument("--serve-fakes", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--api-port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--db-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_fakes:
+        asyncio.run(serve_fakes(args))
+        return
+
+    report = asyncio.run(run(args))
+    report["params"] = {k: v for k, v in vars(args).items() if k not in ("serve_fakes", "api_port", "db_port", "out")}
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,11 +1,35 @@
 import os
+import json
+import time
 import uuid
 import asyncio
 import logging
-from aiohttp import web, ClientSession
+import random
+import signal
+import socket
+import sqlite3
+import tempfile
+import multiprocessing
+import heapq
+import hmac
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from functools import wraps
+from contextvars import ContextVar
+from array import array
+from collections import OrderedDict, deque
+from contextlib import aclosing
+import aiohttp
+from aiohttp import web, ClientSession, TCPConnector, ClientTimeout
 from aiogram import Bot, Dispatcher, Router, types, F
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, ExceptionTypeFilter
 from aiogram.enums import ContentType, ChatMemberStatus
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramServerError,
+)
 from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -15,6 +39,10 @@ from aiogram.types import (
 )
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey, StateType
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.webhook.aiohttp_server import (
     SimpleRequestHandler,
     setup_application,
@@ -27,20 +55,113 @@ TOKEN    = os.environ["BOT_TOKEN"]
 OWNER_ID = int(os.environ["OWNER_ID"])
 BOT_USER = os.environ["BOT_USERNAME"]
 BASE_URL = os.environ.get("RENDER_EXTERNAL_URL", "")
-SUPA_URL = os.environ["SUPABASE_URL"]
-SUPA_KEY = os.environ["SUPABASE_KEY"]
+SUPA_URL = os.environ.get("SUPABASE_URL", "")
+SUPA_KEY = os.environ.get("SUPABASE_KEY", "")
 WH_PATH  = f"/wh/{TOKEN}"
 PORT     = int(os.environ.get("PORT", 10000))
+# Число процессов на одном PORT (SO_REUSEPORT, Linux). Webhook, меню команд
+# и возобновление рассылок — только в воркере 0; нужен FSM_BACKEND=db.
+# Порядок апдейтов одного чата соблюдается только внутри процесса: ядро раздаёт
+# соединения вебхука воркерам без учёта чата, и два быстрых шага /post могут
+# выполниться одновременно в разных воркерах
+WORKERS  = int(os.environ.get("WORKERS", 1))
+# Очередь апдейтов за вебхуком: UPDATE_WORKERS обработчиков, апдейты одного
+# чата — строго по очереди (в пределах процесса, см. WORKERS). Сверх UPDATE_QUEUE_SIZE вебхук отвечает 503,
+# и Telegram повторит доставку позже
+UPDATE_WORKERS    = int(os.environ.get("UPDATE_WORKERS", 64))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 5000))
+UPDATE_DRAIN_SEC  = float(os.environ.get("UPDATE_DRAIN_SEC", 10))
+# Шина инвалидации между воркерами: unix-сокеты в BUS_DIR, heartbeat с номером
+# последнего события, чтобы замечать потерянные
+BUS_DIR           = os.environ.get("BUS_DIR", tempfile.gettempdir())
+BUS_HEARTBEAT_SEC = float(os.environ.get("BUS_HEARTBEAT_SEC", 2))
+# Свой сервер Bot API (local bot api или заглушка для нагрузочных тестов)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")
+# Если задан — /metrics отдаётся только с Authorization: Bearer <token> или ?token=
+METRICS_TOKEN    = os.environ.get("METRICS_TOKEN", "")
+# Отдельный порт для /metrics: воркер n слушает METRICS_PORT + n. При WORKERS > 1
+# /metrics на общем PORT отвечает случайный воркер — скрейпить нужно эти порты
+METRICS_PORT     = int(os.environ.get("METRICS_PORT", 0))
+
+# Трассировка апдейтов: лог, если апдейт сделал больше вызовов хранилища/Bot API,
+# чем TRACE_CALL_BUDGET, или шёл дольше TRACE_SLOW_MS.
+# TRACE_WATERFALL: "all" или user_id через запятую — полный водопад вызовов в лог
+TRACE_CALL_BUDGET = int(os.environ.get("TRACE_CALL_BUDGET", 6))
+TRACE_SLOW_MS     = float(os.environ.get("TRACE_SLOW_MS", 1500))
+TRACE_MAX_CALLS   = int(os.environ.get("TRACE_MAX_CALLS", 200))
+TRACE_WATERFALL   = os.environ.get("TRACE_WATERFALL", "")
 
 CHANNEL_ID   = os.environ.get("CHANNEL_ID", "")
 CHANNEL_LINK = "https://t.me/qwituxcracks"
 OWNER_LINK   = os.environ.get("OWNER_LINK", "https://t.me/venodev")
 START_PHOTO  = os.environ.get("START_PHOTO", "")
 
+# Хранилище: supabase (PostgREST) или sqlite (локальный файл)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase")
+SQLITE_PATH     = os.environ.get("SQLITE_PATH", "filesbot.sqlite3")
+
+# Клиент Supabase: пул соединений, таймауты, повторы, circuit breaker
+SUPA_POOL_SIZE         = int(os.environ.get("SUPA_POOL_SIZE", 20))
+SUPA_KEEPALIVE         = float(os.environ.get("SUPA_KEEPALIVE", 30))
+SUPA_DNS_TTL           = int(os.environ.get("SUPA_DNS_TTL", 300))
+SUPA_TIMEOUT           = float(os.environ.get("SUPA_TIMEOUT", 10))
+SUPA_CONNECT_TIMEOUT   = float(os.environ.get("SUPA_CONNECT_TIMEOUT", 3))
+SUPA_RETRIES           = int(os.environ.get("SUPA_RETRIES", 3))
+SUPA_BACKOFF           = float(os.environ.get("SUPA_BACKOFF", 0.2))
+SUPA_BREAKER_THRESHOLD = int(os.environ.get("SUPA_BREAKER_THRESHOLD", 5))
+SUPA_BREAKER_RESET     = float(os.environ.get("SUPA_BREAKER_RESET", 15))
+
 # Фиксированный канал для не-владельцев (qwitux cracks)
 QWITUX_CHANNEL_ID    = int(os.environ.get("QWITUX_CHANNEL_ID", "-1003696842795"))
 QWITUX_CHANNEL_TITLE = os.environ.get("QWITUX_CHANNEL_TITLE", "Qwitux Cracks")
 
+ROLE_CACHE_TTL  = int(os.environ.get("ROLE_CACHE_TTL", 300))
+ROLE_CACHE_SIZE = int(os.environ.get("ROLE_CACHE_SIZE", 10000))
+BAN_REFRESH_SEC = int(os.environ.get("BAN_REFRESH_SEC", 300))
+
+FILE_CACHE_SIZE      = int(os.environ.get("FILE_CACHE_SIZE", 2000))
+FILE_CACHE_TTL       = int(os.environ.get("FILE_CACHE_TTL", 600))
+FILE_CACHE_NEG_TTL   = int(os.environ.get("FILE_CACHE_NEG_TTL", 60))
+FILE_DISK_CACHE      = os.environ.get("FILE_DISK_CACHE", "file_cache.sqlite3")
+FILE_DISK_CACHE_SIZE = int(os.environ.get("FILE_DISK_CACHE_SIZE", 10000))
+FILE_DISK_CACHE_TTL  = int(os.environ.get("FILE_DISK_CACHE_TTL", 86400))
+
+DOWNLOADS_FLUSH_SEC = int(os.environ.get("DOWNLOADS_FLUSH_SEC", 10))
+FILE_PAGE_SIZE      = int(os.environ.get("FILE_PAGE_SIZE", 10))
+
+# index — триграммный индекс в памяти, server — RPC search_files в Supabase
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "index")
+SEARCH_LIMIT   = int(os.environ.get("SEARCH_LIMIT", 20))
+
+STATS_TTL   = int(os.environ.get("STATS_TTL", 60))
+STATS_TOP_N = 5
+
+# Telegram: ~30 сообщений/с на бота в разные чаты
+BROADCAST_RATE    = float(os.environ.get("BROADCAST_RATE", 25))
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", 16))
+BROADCAST_RETRIES = int(os.environ.get("BROADCAST_RETRIES", 5))
+BROADCAST_CHECKPOINT_SEC = float(os.environ.get("BROADCAST_CHECKPOINT_SEC", 5))
+# Аренда задания: владелец продлевает её на каждом чекпоинте; задание
+# с истёкшей арендой ведущий воркер подбирает заново
+BROADCAST_LEASE_SEC      = float(os.environ.get("BROADCAST_LEASE_SEC", 30))
+USERS_PAGE_SIZE          = int(os.environ.get("USERS_PAGE_SIZE", 1000))
+
+# FSM (черновики /post, /send): memory — в памяти процесса, db — в хранилище,
+# переживает перезапуск (нужна таблица из sql/fsm_states.sql).
+# Запись отложенная: изменения за FSM_FLUSH_SEC сливаются в одну строку на ключ
+FSM_BACKEND    = os.environ.get("FSM_BACKEND", "memory")
+FSM_FLUSH_SEC  = float(os.environ.get("FSM_FLUSH_SEC", 1))
+FSM_CACHE_SIZE = int(os.environ.get("FSM_CACHE_SIZE", 5000))
+FSM_CACHE_TTL  = int(os.environ.get("FSM_CACHE_TTL", 600))
+
+USERS_FLUSH_SEC = float(os.environ.get("USERS_FLUSH_SEC", 5))
+USER_SEEN_TTL   = int(os.environ.get("USER_SEEN_TTL", 3600))
+USER_SEEN_SIZE  = int(os.environ.get("USER_SEEN_SIZE", 50000))
+
+MEMBER_CACHE_TTL     = int(os.environ.get("MEMBER_CACHE_TTL", 3600))
+MEMBER_CACHE_NEG_TTL = int(os.environ.get("MEMBER_CACHE_NEG_TTL", 15))
+MEMBER_CACHE_SIZE    = int(os.environ.get("MEMBER_CACHE_SIZE", 100000))
+
 sub_required   = True if CHANNEL_ID else False
 notify_uploads = True
 
@@ -49,8 +170,1464 @@ USERS_TABLE  = f"{SUPA_URL}/rest/v1/users"
 ADMINS_TABLE = f"{SUPA_URL}/rest/v1/admins"
 BANS_TABLE   = f"{SUPA_URL}/rest/v1/bans"
 CHANNELS_TABLE = f"{SUPA_URL}/rest/v1/channels"
+SETTINGS_TABLE = f"{SUPA_URL}/rest/v1/bot_settings"
+BROADCASTS_TABLE = f"{SUPA_URL}/rest/v1/broadcast_jobs"
+RECIPIENTS_TABLE = f"{SUPA_URL}/rest/v1/broadcast_recipients"
+FSM_TABLE        = f"{SUPA_URL}/rest/v1/fsm_states"
+RPC_URL        = f"{SUPA_URL}/rest/v1/rpc"
+
+# ══════════════════════════════════════════════
+#  МЕТРИКИ
+# ══════════════════════════════════════════════
+# Минимальный реестр в текстовом формате Prometheus, без новых зависимостей.
+# Значения — dict по кортежу меток: обновление — одно сложение (гистограмма — ещё bisect).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+metrics_registry: list = []
+# worker="n" у всех метрик при WORKERS > 1: ряды разных процессов не смешиваются
+metrics_worker_label = ""
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    kind = "untyped"
+
+    # collect — функция без аргументов, возвращает {метки: значение} на момент скрейпа
+    def __init__(self, name: str, help: str, labels: tuple = (), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.values: dict[tuple, float] = {}
+        metrics_registry.append(self)
+
+    def _labels(self, values: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{_label_value(v)}"' for k, v in zip(self.labels, values)]
+        if metrics_worker_label:
+            parts.append(metrics_worker_label)
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def samples(self) -> list[str]:
+        values = self.collect() if self.collect else self.values
+        return [f"{self.name}{self._labels(k)} {v}" for k, v in values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def inc(self, labels: tuple = (), value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class GaugeMetric(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+    def inc(self, labels: tuple = (), value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, labels: tuple = ()):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = self._labels(labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            cumulative += counts[-1]
+            le = self._labels(labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in metrics_registry) + "\n"
+
+
+updates_total = CounterMetric("filesbot_updates_total", "Updates received, by type", ("type",))
+updates_in_flight = GaugeMetric("filesbot_updates_in_flight", "Updates being handled right now")
+handler_seconds = HistogramMetric("filesbot_handler_seconds", "Handler latency", ("handler",))
+handler_errors = CounterMetric("filesbot_handler_errors_total", "Handler exceptions", ("handler",))
+
+supa_requests = CounterMetric(
+    "filesbot_supabase_requests_total", "Supabase HTTP attempts, by table, method and status",
+    ("table", "method", "status"),
+)
+supa_seconds = HistogramMetric(
+    "filesbot_supabase_request_seconds", "Supabase HTTP attempt latency", ("table", "method"),
+)
+
+tg_requests = CounterMetric(
+    "filesbot_telegram_requests_total", "Bot API calls, by method and outcome", ("method", "outcome"),
+)
+tg_seconds = HistogramMetric("filesbot_telegram_request_seconds", "Bot API call latency", ("method",))
+tg_retry_after = CounterMetric(
+    "filesbot_telegram_retry_after_total", "Bot API 429 RetryAfter responses", ("method",),
+)
+
+
+def supa_table(url: str) -> str:
+    # .../rest/v1/files?... -> files, .../rest/v1/rpc/bot_stats -> rpc/bot_stats
+    path = url.split("?", 1)[0]
+    marker = path.find("/rest/v1/")
+    return path[marker + 9:] if marker >= 0 else path
+
+
+async def telegram_metrics(make_request, bot_, method):
+    name = method.__api_method__
+    outcome = "ok"
+    t = time.perf_counter()
+    try:
+        return await make_request(bot_, method)
+    except TelegramRetryAfter:
+        outcome = "retry_after"
+        tg_retry_after.inc((name,))
+        raise
+    except TelegramForbiddenError:
+        outcome = "forbidden"
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        tg_seconds.observe(time.perf_counter() - t, (name,))
+        tg_requests.inc((name, outcome))
+
+
+# ══════════════════════════════════════════════
+#  КЛИЕНТ SUPABASE
+# ══════════════════════════════════════════════
+class StorageError(Exception):
+    pass
+
+
+class SupabaseError(StorageError):
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+
+class CircuitOpenError(SupabaseError):
+    pass
+
+
+# Ответ, уже прочитанный целиком: соединение сразу возвращается в пул
+class SupaResponse:
+    def __init__(self, status: int, headers, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    async def json(self):
+        return json.loads(self.body) if self.body else None
+
+    async def text(self) -> str:
+        return self.body.decode("utf-8", "replace")
+
+
+# Позволяет писать и `await http.get(...)`, и `async with http.get(...) as r`
+class _SupaRequest:
+    def __init__(self, coro):
+        self._coro = coro
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self) -> SupaResponse:
+        return await self._coro
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class SupabaseClient:
+    def __init__(self, key: str):
+        self.key = key
+        self.session: ClientSession | None = None
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_inflight = False
+
+    async def start(self):
+        connector = TCPConnector(
+            limit=SUPA_POOL_SIZE,
+            ttl_dns_cache=SUPA_DNS_TTL,
+            keepalive_timeout=SUPA_KEEPALIVE,
+        )
+        self.session = ClientSession(
+            connector=connector,
+            timeout=ClientTimeout(total=SUPA_TIMEOUT, connect=SUPA_CONNECT_TIMEOUT),
+            headers={
+                "apikey": self.key,
+                "Authorization": f"Bearer {self.key}",
+                "Content-Type": "application/json",
+            },
+        )
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    @property
+    def circuit_open(self) -> bool:
+        return self._consecutive_failures >= SUPA_BREAKER_THRESHOLD
+
+    # closed -> (N ошибок подряд) -> open -> (SUPA_BREAKER_RESET) -> один пробный запрос
+    def _before_request(self) -> bool:
+        if not self.circuit_open:
+            return False
+        if time.monotonic() - self._opened_at < SUPA_BREAKER_RESET or self._probe_inflight:
+            raise CircuitOpenError("Supabase circuit open")
+        self._probe_inflight = True
+        return True
+
+    def _on_success(self):
+        self._consecutive_failures = 0
+
+    def _on_failure(self):
+        self.failures += 1
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= SUPA_BREAKER_THRESHOLD:
+            self._opened_at = time.monotonic()
+
+    async def _request(self, method: str, url: str, idempotent: bool, **kwargs) -> SupaResponse:
+        attempts = SUPA_RETRIES + 1 if idempotent else 1
+        for attempt in range(attempts):
+            probe = self._before_request()
+            self.requests += 1
+            error = None
+            table = supa_table(url)
+            t = time.perf_counter()
+            try:
+                async with self.session.request(method, url, **kwargs) as r:
+                    body = await r.read()
+                    response = SupaResponse(r.status, r.headers, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                supa_requests.inc((table, method, type(e).__name__))
+                error = SupabaseError(f"{method} {url.split('?')[0]}: {type(e).__name__} {e}")
+            else:
+                supa_requests.inc((table, method, str(response.status)))
+                if response.status < 400:
+                    self._on_success()
+                    return response
+                error = SupabaseError(
+                    f"{method} {url.split('?')[0]}: {response.status} {body[:300].decode('utf-8', 'replace')}",
+                    response.status,
+                )
+                if response.status not in RETRY_STATUSES:
+                    # 4xx — ошибка запроса, а не базы: breaker не трогаем
+                    self._on_success()
+                    raise error
+            finally:
+                supa_seconds.observe(time.perf_counter() - t, (table, method))
+                if probe:
+                    self._probe_inflight = False
+
+            self._on_failure()
+            if attempt + 1 >= attempts or self.circuit_open:
+                raise error
+            self.retries += 1
+            # Экспоненциальная задержка с полным джиттером
+            await asyncio.sleep(random.uniform(0, SUPA_BACKOFF * 2 ** attempt))
+
+    def request(self, method: str, url: str, idempotent: bool = None, **kwargs) -> _SupaRequest:
+        if idempotent is None:
+            idempotent = method in ("GET", "HEAD", "DELETE")
+        return _SupaRequest(self._request(method, url, idempotent, **kwargs))
+
+    def get(self, url: str, **kwargs) -> _SupaRequest:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> _SupaRequest:
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> _SupaRequest:
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> _SupaRequest:
+        return self.request("DELETE", url, **kwargs)
+
+
+http = SupabaseClient(SUPA_KEY)
+
+
+# ══════════════════════════════════════════════
+#  ТРАССИРОВКА
+# ══════════════════════════════════════════════
+# Вызовы хранилища и Bot API, сделанные при обработке одного апдейта.
+# Задачи, запущенные из хендлера (рассылка), наследуют контекст — после
+# закрытия трассы их вызовы уже не пишутся.
+class UpdateTrace:
+    def __init__(self, update_id: int, event_type: str, user_id: int | None):
+        self.update_id = update_id
+        self.event_type = event_type
+        self.user_id = user_id
+        self.handler = None
+        self.started = time.perf_counter()
+        self.calls: list[tuple] = []   # (kind, name, start, duration, error)
+        self.dropped = 0
+        self.closed = False
+
+    def record(self, kind: str, name: str, start: float, error: str | None):
+        if self.closed:
+            return
+        if len(self.calls) >= TRACE_MAX_CALLS:
+            self.dropped += 1
+            return
+        self.calls.append((kind, name, start, time.perf_counter() - start, error))
+
+    @property
+    def call_count(self) -> int:
+        return len(self.calls) + self.dropped
+
+    def to_dict(self, duration: float) -> dict:
+        counts: dict[str, int] = {}
+        for kind, name, *_ in self.calls:
+            counts[f"{kind}.{name}"] = counts.get(f"{kind}.{name}", 0) + 1
+        return {
+            "update_id": self.update_id,
+            "type": self.event_type,
+            "user_id": self.user_id,
+            "handler": self.handler,
+            "ms": round(duration * 1000, 1),
+            "calls": self.call_count,
+            "storage": sum(1 for c in self.calls if c[0] == "storage"),
+            "bot_api": sum(1 for c in self.calls if c[0] == "bot_api"),
+            "repeated": {k: v for k, v in counts.items() if v > 1},
+            "waterfall": [
+                {
+                    "call": f"{kind}.{name}",
+                    "at_ms": round((start - self.started) * 1000, 1),
+                    "ms": round(dur * 1000, 1),
+                    **({"error": error} if error else {}),
+                }
+                for kind, name, start, dur, error in self.calls
+            ],
+        }
+
+    def waterfall(self, duration: float, width: int = 40) -> str:
+        total = max(duration, 1e-6)
+        lines = [
+            f"Update {self.update_id} {self.event_type} {self.handler or '-'}: "
+            f"{duration * 1000:.1f} ms, {self.call_count} calls"
+        ]
+        for kind, name, start, dur, error in self.calls:
+            offset = start - self.started
+            pad = int(offset / total * width)
+            bar = " " * pad + "█" * max(1, min(width - pad, int(dur / total * width)))
+            lines.append(
+                f"  {offset * 1000:8.1f} +{dur * 1000:7.1f} ms  {kind:<7} {name:<26} |{bar:<{width}}|"
+                + (f" {error}" if error else "")
+            )
+        return "\n".join(lines)
+
+
+current_trace: ContextVar[UpdateTrace | None] = ContextVar("current_trace", default=None)
+waterfall_users = {int(x) for x in TRACE_WATERFALL.split(",") if x.strip().lstrip("-").isdigit()}
+
+
+def traced(kind: str, name: str, fn):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        trace = current_trace.get()
+        if trace is None or trace.closed:
+            return await fn(*args, **kwargs)
+        start = time.perf_counter()
+        error = None
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            trace.record(kind, name, start, error)
+    return wrapper
+
+
+async def trace_telegram(make_request, bot_, method):
+    trace = current_trace.get()
+    if trace is None or trace.closed:
+        return await make_request(bot_, method)
+    start = time.perf_counter()
+    error = None
+    try:
+        return await make_request(bot_, method)
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace.record("bot_api", method.__api_method__, start, error)
+
+
+def event_user_id(update: types.Update) -> int | None:
+    event = update.event
+    user = getattr(event, "from_user", None)
+    return user.id if user else None
+
+
+# ══════════════════════════════════════════════
+#  ХРАНИЛИЩЕ
+# ══════════════════════════════════════════════
+# Все запросы к данным идут через storage; кэши и буферы — выше по стеку,
+# в функциях db_* / get_role / is_banned и т.д.
+class Storage(ABC):
+    name = "base"
+
+    # Публичные методы реализаций попадают в трассу апдейта
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for attr, fn in list(vars(cls).items()):
+            if attr.startswith("_") or attr in ("start", "close") or not asyncio.iscoroutinefunction(fn):
+                continue
+            setattr(cls, attr, traced("storage", attr, fn))
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    # ── админы ──
+    @abstractmethod
+    async def get_admin(self, user_id: int) -> dict | None:
+        ...
+
+    @abstractmethod
+    async def get_admins(self, user_ids: list[int]) -> list[dict]:
+        ...
+
+    @abstractmethod
+    async def get_all_admins(self) -> list[dict]:
+        ...
+
+    # Всё о пользователе за один запрос: {"admin": dict | None, "banned": bool}
+    @abstractmethod
+    async def get_user_context(self, user_id: int) -> dict:
+        ...
+
+    @abstractmethod
+    async def insert_admin(self, user_id: int, role: int, username: str):
+        ...
+
+    @abstractmethod
+    async def update_admin(self, user_id: int, role: int, username: str):
+        ...
+
+    @abstractmethod
+    async def delete_admin(self, user_id: int):
+        ...
+
+    # ── баны ──
+    @abstractmethod
+    async def is_banned(self, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def get_banned_ids(self) -> list[int]:
+        ...
+
+    @abstractmethod
+    async def add_ban(self, user_id: int, reason: str, banned_by: int):
+        ...
+
+    @abstractmethod
+    async def remove_ban(self, user_id: int):
+        ...
+
+    # ── каналы ──
+    @abstractmethod
+    async def save_channel(self, chat_id: int, title: str):
+        ...
+
+    @abstractmethod
+    async def remove_channel(self, chat_id: int):
+        ...
+
+    @abstractmethod
+    async def get_all_channels(self) -> list[dict]:
+        ...
+
+    # ── настройки ──
+    # name -> значение (JSON)
+    @abstractmethod
+    async def get_settings(self) -> dict:
+        ...
+
+    @abstractmethod
+    async def save_setting(self, name: str, value):
+        ...
+
+    # ── файлы ──
+    @abstractmethod
+    async def get_file(self, code: str) -> dict | None:
+        ...
+
+    @abstractmethod
+    async def insert_file(self, row: dict):
+        ...
+
+    @abstractmethod
+    async def delete_file(self, code: str):
+        ...
+
+    @abstractmethod
+    async def rename_file(self, code: str, new_name: str):
+        ...
+
+    @abstractmethod
+    async def increment_downloads(self, deltas: dict[str, int]):
+        ...
+
+    # Keyset-страница по (created_at, code): вперёд — к старым, назад — к новым
+    @abstractmethod
+    async def files_page(self, uploaded_by: int | None, cursor: tuple | None,
+                         backward: bool, limit: int) -> list[dict]:
+        ...
+
+    # Все файлы по возрастанию code, для загрузки поискового индекса
+    @abstractmethod
+    async def scan_files(self, after_code: str, limit: int) -> list[dict]:
+        ...
+
+    @abstractmethod
+    async def search_files(self, query: str, limit: int) -> tuple[list[dict], int]:
+        ...
+
+    @abstractmethod
+    async def bot_stats(self, top_n: int) -> dict:
+        ...
+
+    @abstractmethod
+    async def uploader_stats(self) -> list[dict]:
+        ...
+
+    # ── пользователи ──
+    @abstractmethod
+    async def upsert_users(self, rows: list[dict]):
+        ...
+
+    @abstractmethod
+    async def mark_users_inactive(self, user_ids: list[int]):
+        ...
+
+    @abstractmethod
+    async def active_user_ids(self, after: int, limit: int) -> array:
+        ...
+
+    @abstractmethod
+    async def count_users(self, active_only: bool = False) -> int:
+        ...
+
+    # ── рассылки ──
+    @abstractmethod
+    async def create_broadcast_job(self, row: dict) -> dict:
+        ...
+
+    @abstractmethod
+    async def get_broadcast_job(self, job_id: int) -> dict | None:
+        ...
+
+    @abstractmethod
+    async def get_running_broadcast_jobs(self) -> list[dict]:
+        ...
+
+    @abstractmethod
+    async def update_broadcast_job(self, job_id: int, fields: dict):
+        ...
+
+    # Условный переход: обновляет задание, только если его статус всё ещё
+    # from_status и у него нет живого владельца (owner пуст или lease_until < now);
+    # возвращает новую строку или None, если задание уже забрали
+    @abstractmethod
+    async def claim_broadcast_job(self, job_id: int, from_status: str, fields: dict,
+                                  now: float) -> dict | None:
+        ...
+
+    @abstractmethod
+    async def save_broadcast_outcomes(self, rows: list[dict]):
+        ...
+
+    @abstractmethod
+    async def get_broadcast_done_after(self, job_id: int, cursor: int) -> set[int]:
+        ...
+
+    # ── состояния FSM ──
+    # {"state": str | None, "data": dict} или None
+    @abstractmethod
+    async def get_fsm(self, key: str) -> dict | None:
+        ...
+
+    # rows: [{"key", "state", "data"}], upsert по key
+    @abstractmethod
+    async def save_fsm(self, rows: list[dict]):
+        ...
+
+    @abstractmethod
+    async def delete_fsm(self, keys: list[str]):
+        ...
+
+
+FILE_LIST_COLUMNS = "code,name,downloads,uploader_name,uploader_role,created_at"
+SEARCH_COLUMNS = "code,name,caption,downloads,uploader_name,uploader_role"
+
+
+class SupabaseStorage(Storage):
+    name = "supabase"
+
+    def __init__(self, client: SupabaseClient):
+        self.http = client
+
+    async def start(self):
+        await self.http.start()
+
+    async def close(self):
+        await self.http.close()
+
+    # ── админы ──
+    async def get_admin(self, user_id):
+        async with self.http.get(f"{ADMINS_TABLE}?user_id=eq.{user_id}&select=*") as r:
+            data = await r.json()
+            return data[0] if data else None
+
+    async def get_admins(self, user_ids):
+        ids = ",".join(str(uid) for uid in user_ids)
+        async with self.http.get(f"{ADMINS_TABLE}?user_id=in.({ids})&select=*") as r:
+            return await r.json()
+
+    async def get_all_admins(self):
+        async with self.http.get(f"{ADMINS_TABLE}?select=*&order=role.desc") as r:
+            return await r.json()
+
+    async def get_user_context(self, user_id):
+        async with self.http.post(f"{RPC_URL}/user_context", json={"uid": user_id}, idempotent=True) as r:
+            return await r.json()
+
+    async def insert_admin(self, user_id, role, username):
+        async with self.http.post(
+            ADMINS_TABLE,
+            json={"user_id": user_id, "role": role, "username": username},
+            headers={"Prefer": "return=minimal"}
+        ) as r:
+            pass
+
+    async def update_admin(self, user_id, role, username):
+        async with self.http.patch(
+            f"{ADMINS_TABLE}?user_id=eq.{user_id}",
+            json={"role": role, "username": username},
+            idempotent=True,
+        ) as r:
+            pass
+
+    async def delete_admin(self, user_id):
+        async with self.http.delete(f"{ADMINS_TABLE}?user_id=eq.{user_id}") as r:
+            pass
+
+    # ── баны ──
+    async def is_banned(self, user_id):
+        async with self.http.get(f"{BANS_TABLE}?user_id=eq.{user_id}&select=user_id") as r:
+            data = await r.json()
+            return len(data) > 0
+
+    async def get_banned_ids(self):
+        async with self.http.get(f"{BANS_TABLE}?select=user_id") as r:
+            rows = await r.json()
+            return [row["user_id"] for row in rows]
+
+    async def add_ban(self, user_id, reason, banned_by):
+        async with self.http.post(
+            BANS_TABLE,
+            json={"user_id": user_id, "reason": reason, "banned_by": banned_by},
+            headers={"Prefer": "return=minimal"}
+        ) as r:
+            pass
+
+    async def remove_ban(self, user_id):
+        async with self.http.delete(f"{BANS_TABLE}?user_id=eq.{user_id}") as r:
+            pass
+
+    # ── каналы ──
+    async def save_channel(self, chat_id, title):
+        try:
+            async with self.http.post(
+                CHANNELS_TABLE,
+                json={"chat_id": chat_id, "title": title},
+                headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+                idempotent=True,
+            ) as r:
+                pass
+        except CircuitOpenError:
+            raise
+        except SupabaseError:
+            async with self.http.patch(
+                f"{CHANNELS_TABLE}?chat_id=eq.{chat_id}",
+                json={"title": title},
+                idempotent=True,
+            ) as r2:
+                pass
+
+    async def remove_channel(self, chat_id):
+        async with self.http.delete(f"{CHANNELS_TABLE}?chat_id=eq.{chat_id}") as r:
+            pass
+
+    async def get_all_channels(self):
+        async with self.http.get(f"{CHANNELS_TABLE}?select=*&order=title.asc") as r:
+            data = await r.json()
+            return data if isinstance(data, list) else []
+
+    # ── настройки ──
+    async def get_settings(self):
+        async with self.http.get(f"{SETTINGS_TABLE}?select=name,value") as r:
+            rows = await r.json()
+            return {row["name"]: row["value"] for row in rows}
+
+    async def save_setting(self, name, value):
+        async with self.http.post(
+            SETTINGS_TABLE, json={"name": name, "value": value},
+            headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+            idempotent=True,
+        ) as r:
+            pass
+
+    # ── файлы ──
+    async def get_file(self, code):
+        async with self.http.get(f"{FILES_TABLE}?code=eq.{code}&select=*") as r:
+            data = await r.json()
+            return data[0] if data else None
+
+    async def insert_file(self, row):
+        async with self.http.post(FILES_TABLE, json=row, headers={"Prefer": "return=minimal"}) as r:
+            pass
+
+    async def delete_file(self, code):
+        async with self.http.delete(f"{FILES_TABLE}?code=eq.{code}") as r:
+            pass
+
+    async def rename_file(self, code, new_name):
+        async with self.http.patch(
+            f"{FILES_TABLE}?code=eq.{code}",
+            json={"name": new_name},
+            idempotent=True,
+        ) as r:
+            pass
+
+    async def increment_downloads(self, deltas):
+        async with self.http.post(
+            f"{RPC_URL}/increment_downloads",
+            json={"codes": list(deltas), "deltas": list(deltas.values())},
+        ) as r:
+            pass
+
+    async def files_page(self, uploaded_by, cursor, backward, limit):
+        op, order = ("gt", "asc") if backward else ("lt", "desc")
+        params = {
+            "select": FILE_LIST_COLUMNS,
+            "order": f"created_at.{order},code.{order}",
+            "limit": str(limit),
+        }
+        if uploaded_by is not None:
+            params["uploaded_by"] = f"eq.{uploaded_by}"
+        if cursor:
+            created_at, code = cursor
+            params["or"] = (
+                f'(created_at.{op}."{created_at}",'
+                f'and(created_at.eq."{created_at}",code.{op}.{code}))'
+            )
+        async with self.http.get(FILES_TABLE, params=params) as r:
+            return await r.json()
+
+    async def scan_files(self, after_code, limit):
+        url = f"{FILES_TABLE}?select={SEARCH_COLUMNS}&order=code.asc&limit={limit}"
+        if after_code:
+            url += f"&code=gt.{after_code}"
+        async with self.http.get(url) as r:
+            return await r.json()
+
+    async def search_files(self, query, limit):
+        async with self.http.post(
+            f"{RPC_URL}/search_files", json={"q": query, "lim": limit}, idempotent=True
+        ) as r:
+            data = await r.json()
+        return data.get("rows") or [], data.get("total") or 0
+
+    async def bot_stats(self, top_n):
+        async with self.http.post(f"{RPC_URL}/bot_stats", json={"top_n": top_n}, idempotent=True) as r:
+            return await r.json()
+
+    async def uploader_stats(self):
+        async with self.http.post(f"{RPC_URL}/uploader_stats", json={}, idempotent=True) as r:
+            rows = await r.json()
+        return rows if isinstance(rows, list) else []
+
+    # ── пользователи ──
+    async def upsert_users(self, rows):
+        async with self.http.post(
+            f"{USERS_TABLE}?on_conflict=user_id",
+            json=rows,
+            headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+            idempotent=True,
+        ) as r:
+            pass
+
+    async def mark_users_inactive(self, user_ids, chunk: int = 500):
+        for i in range(0, len(user_ids), chunk):
+            ids = ",".join(str(uid) for uid in user_ids[i:i + chunk])
+            async with self.http.patch(
+                f"{USERS_TABLE}?user_id=in.({ids})", json={"active": False}, idempotent=True
+            ) as r:
+                pass
+
+    async def active_user_ids(self, after, limit):
+        async with self.http.get(
+            f"{USERS_TABLE}?select=user_id&active=is.true"
+            f"&user_id=gt.{after}&order=user_id.asc&limit={limit}"
+        ) as r:
+            rows = await r.json()
+        return array("q", (row["user_id"] for row in rows))
+
+    async def count_users(self, active_only=False):
+        query = "&active=is.true" if active_only else ""
+        async with self.http.get(
+            f"{USERS_TABLE}?select=user_id{query}",
+            headers={"Prefer": "count=exact"}
+        ) as r:
+            cr = r.headers.get("content-range", "")
+            try:
+                return int(cr.split("/")[1])
+            except Exception:
+                data = await r.json()
+                return len(data)
+
+    # ── рассылки ──
+    async def create_broadcast_job(self, row):
+        async with self.http.post(
+            BROADCASTS_TABLE, json=row, headers={"Prefer": "return=representation"}
+        ) as r:
+            data = await r.json()
+            return data[0]
+
+    async def get_broadcast_job(self, job_id):
+        async with self.http.get(f"{BROADCASTS_TABLE}?id=eq.{job_id}&select=*") as r:
+            data = await r.json()
+            return data[0] if data else None
+
+    async def get_running_broadcast_jobs(self):
+        async with self.http.get(f"{BROADCASTS_TABLE}?status=eq.running&select=*&order=id.asc") as r:
+            data = await r.json()
+            return data if isinstance(data, list) else []
+
+    async def update_broadcast_job(self, job_id, fields):
+        async with self.http.patch(
+            f"{BROADCASTS_TABLE}?id=eq.{job_id}", json=fields, idempotent=True
+        ) as r:
+            pass
+
+    async def claim_broadcast_job(self, job_id, from_status, fields, now):
+        # Не повторяем: после таймаута строка могла уже смениться нашим же запросом
+        async with self.http.patch(
+            f"{BROADCASTS_TABLE}?id=eq.{job_id}&status=eq.{from_status}"
+            f"&or=(owner.is.null,lease_until.lt.{now})", json=fields,
+            headers={"Prefer": "return=representation"},
+        ) as r:
+            rows = await r.json()
+            return rows[0] if len(rows) == 1 else None
+
+    async def save_broadcast_outcomes(self, rows):
+        async with self.http.post(
+            RECIPIENTS_TABLE, json=rows,
+            headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+            idempotent=True,
+        ) as r:
+            pass
+
+    async def get_broadcast_done_after(self, job_id, cursor):
+        async with self.http.get(
+            f"{RECIPIENTS_TABLE}?job_id=eq.{job_id}&user_id=gt.{cursor}&select=user_id"
+        ) as r:
+            rows = await r.json()
+            return {row["user_id"] for row in rows}
+
+    # ── состояния FSM ──
+    async def get_fsm(self, key):
+        async with self.http.get(FSM_TABLE, params={"key": f"eq.{key}", "select": "state,data"}) as r:
+            data = await r.json()
+            return data[0] if data else None
+
+    async def save_fsm(self, rows):
+        async with self.http.post(
+            FSM_TABLE, json=rows,
+            headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+            idempotent=True,
+        ) as r:
+            pass
+
+    async def delete_fsm(self, keys):
+        keys = ",".join(f'"{key}"' for key in keys)
+        async with self.http.delete(f"{FSM_TABLE}?key=in.({keys})") as r:
+            pass
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    code          TEXT PRIMARY KEY,
+    file_id       TEXT NOT NULL,
+    type          TEXT NOT NULL,
+    name          TEXT,
+    caption       TEXT,
+    downloads     INTEGER NOT NULL DEFAULT 0,
+    uploaded_by   INTEGER,
+    uploader_role INTEGER,
+    uploader_name TEXT,
+    created_at    TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+CREATE INDEX IF NOT EXISTS files_created_code_idx ON files (created_at, code);
+CREATE INDEX IF NOT EXISTS files_uploader_created_code_idx ON files (uploaded_by, created_at, code);
+CREATE INDEX IF NOT EXISTS files_downloads_idx ON files (downloads);
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id    INTEGER PRIMARY KEY,
+    username   TEXT,
+    first_name TEXT,
+    active     INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS users_active_user_id_idx ON users (user_id) WHERE active;
+
+CREATE TABLE IF NOT EXISTS admins (
+    user_id  INTEGER PRIMARY KEY,
+    role     INTEGER NOT NULL,
+    username TEXT
+);
+
+CREATE TABLE IF NOT EXISTS bans (
+    user_id   INTEGER PRIMARY KEY,
+    reason    TEXT,
+    banned_by INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS channels (
+    chat_id INTEGER PRIMARY KEY,
+    title   TEXT
+);
+
+CREATE TABLE IF NOT EXISTS bot_settings (
+    name  TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id                INTEGER PRIMARY KEY AUTOINCREMENT,
+    from_chat_id      INTEGER NOT NULL,
+    message_id        INTEGER NOT NULL,
+    status_chat_id    INTEGER,
+    status_message_id INTEGER,
+    status            TEXT NOT NULL DEFAULT 'running',
+    cursor            INTEGER NOT NULL DEFAULT 0,
+    total             INTEGER NOT NULL DEFAULT 0,
+    sent              INTEGER NOT NULL DEFAULT 0,
+    failed            INTEGER NOT NULL DEFAULT 0,
+    blocked           INTEGER NOT NULL DEFAULT 0,
+    owner             TEXT,
+    lease_until       REAL,
+    created_at        TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+    job_id  INTEGER NOT NULL REFERENCES broadcast_jobs (id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    outcome TEXT NOT NULL,
+    PRIMARY KEY (job_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key   TEXT PRIMARY KEY,
+    state TEXT,
+    data  TEXT NOT NULL DEFAULT '{}'
+);
+"""
+
+BROADCAST_JOB_FIELDS = {"status", "cursor", "total", "sent", "failed", "blocked", "owner", "lease_until"}
+
+# Колонки, добавленные после первой версии схемы: для уже созданных баз
+SQLITE_MIGRATIONS = (
+    "ALTER TABLE broadcast_jobs ADD COLUMN owner TEXT",
+    "ALTER TABLE broadcast_jobs ADD COLUMN lease_until REAL",
+)
+
+
+# Локальная база для небольших установок, тестов и бенчмарков.
+# Запросы — константные строки с параметрами: sqlite3 держит их
+# скомпилированными в кэше подготовленных выражений соединения.
+class SQLiteStorage(Storage):
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: sqlite3.Connection | None = None
+
+    async def start(self):
+        self.conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=256)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        # lower() в SQLite понимает только ASCII — для кириллицы берём питоновский
+        self.conn.create_function("py_lower", 1, lambda s: s.lower() if s else "", deterministic=True)
+        self.conn.executescript(SQLITE_SCHEMA)
+        for sql in SQLITE_MIGRATIONS:
+            try:
+                self.conn.execute(sql)
+            except sqlite3.OperationalError:
+                pass  # колонка уже есть
+
+    async def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def _exec(self, sql: str, params=()) -> sqlite3.Cursor:
+        try:
+            return self.conn.execute(sql, params)
+        except sqlite3.Error as e:
+            raise StorageError(f"sqlite: {e}") from e
+
+    def _many(self, sql: str, seq):
+        try:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(sql, seq)
+        except sqlite3.Error as e:
+            raise StorageError(f"sqlite: {e}") from e
+
+    def _one(self, sql: str, params=()) -> dict | None:
+        row = self._exec(sql, params).fetchone()
+        return dict(row) if row else None
+
+    def _all(self, sql: str, params=()) -> list[dict]:
+        return [dict(row) for row in self._exec(sql, params)]
+
+    def _scalar(self, sql: str, params=()):
+        return self._exec(sql, params).fetchone()[0]
+
+    # ── админы ──
+    async def get_admin(self, user_id):
+        return self._one("SELECT * FROM admins WHERE user_id = ?", (user_id,))
+
+    async def get_admins(self, user_ids):
+        ids = list(user_ids)
+        marks = ",".join("?" * len(ids))
+        return self._all(f"SELECT * FROM admins WHERE user_id IN ({marks})", ids)
+
+    async def get_all_admins(self):
+        return self._all("SELECT * FROM admins ORDER BY role DESC")
+
+    async def get_user_context(self, user_id):
+        row = self._one(
+            "SELECT a.role, a.username, "
+            "EXISTS (SELECT 1 FROM bans WHERE user_id = :uid) AS banned "
+            "FROM (SELECT :uid AS user_id) q LEFT JOIN admins a ON a.user_id = q.user_id",
+            {"uid": user_id},
+        )
+        admin = None
+        if row["role"] is not None:
+            admin = {"user_id": user_id, "role": row["role"], "username": row["username"]}
+        return {"admin": admin, "banned": bool(row["banned"])}
+
+    async def insert_admin(self, user_id, role, username):
+        self._exec(
+            "INSERT INTO admins (user_id, role, username) VALUES (?, ?, ?)", (user_id, role, username)
+        )
+
+    async def update_admin(self, user_id, role, username):
+        self._exec(
+            "UPDATE admins SET role = ?, username = ? WHERE user_id = ?", (role, username, user_id)
+        )
+
+    async def delete_admin(self, user_id):
+        self._exec("DELETE FROM admins WHERE user_id = ?", (user_id,))
+
+    # ── баны ──
+    async def is_banned(self, user_id):
+        return self._one("SELECT 1 AS x FROM bans WHERE user_id = ?", (user_id,)) is not None
+
+    async def get_banned_ids(self):
+        return [row[0] for row in self._exec("SELECT user_id FROM bans")]
+
+    async def add_ban(self, user_id, reason, banned_by):
+        self._exec(
+            "INSERT OR REPLACE INTO bans (user_id, reason, banned_by) VALUES (?, ?, ?)",
+            (user_id, reason, banned_by),
+        )
+
+    async def remove_ban(self, user_id):
+        self._exec("DELETE FROM bans WHERE user_id = ?", (user_id,))
 
-http: ClientSession = None
+    # ── каналы ──
+    async def save_channel(self, chat_id, title):
+        self._exec(
+            "INSERT INTO channels (chat_id, title) VALUES (?, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET title = excluded.title",
+            (chat_id, title),
+        )
+
+    async def remove_channel(self, chat_id):
+        self._exec("DELETE FROM channels WHERE chat_id = ?", (chat_id,))
+
+    async def get_all_channels(self):
+        return self._all("SELECT * FROM channels ORDER BY title")
+
+    # ── настройки ──
+    async def get_settings(self):
+        return {row["name"]: json.loads(row["value"]) for row in self._all("SELECT name, value FROM bot_settings")}
+
+    async def save_setting(self, name, value):
+        self._exec(
+            "INSERT OR REPLACE INTO bot_settings (name, value) VALUES (?, ?)", (name, json.dumps(value))
+        )
+
+    # ── файлы ──
+    async def get_file(self, code):
+        return self._one("SELECT * FROM files WHERE code = ?", (code,))
+
+    async def insert_file(self, row):
+        cols = ",".join(row)
+        marks = ",".join("?" * len(row))
+        self._exec(f"INSERT INTO files ({cols}) VALUES ({marks})", list(row.values()))
+
+    async def delete_file(self, code):
+        self._exec("DELETE FROM files WHERE code = ?", (code,))
+
+    async def rename_file(self, code, new_name):
+        self._exec("UPDATE files SET name = ? WHERE code = ?", (new_name, code))
+
+    async def increment_downloads(self, deltas):
+        self._many(
+            "UPDATE files SET downloads = downloads + ? WHERE code = ?",
+            [(delta, code) for code, delta in deltas.items()],
+        )
+
+    async def files_page(self, uploaded_by, cursor, backward, limit):
+        op, order = (">", "ASC") if backward else ("<", "DESC")
+        where, params = [], []
+        if uploaded_by is not None:
+            where.append("uploaded_by = ?")
+            params.append(uploaded_by)
+        if cursor:
+            where.append(f"(created_at, code) {op} (?, ?)")
+            params.extend(cursor)
+        sql = f"SELECT {FILE_LIST_COLUMNS} FROM files"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY created_at {order}, code {order} LIMIT ?"
+        return self._all(sql, params + [limit])
+
+    async def scan_files(self, after_code, limit):
+        return self._all(
+            f"SELECT {SEARCH_COLUMNS} FROM files WHERE code > ? ORDER BY code LIMIT ?",
+            (after_code or "", limit),
+        )
+
+    async def search_files(self, query, limit):
+        q = query.lower()
+        where = "instr(py_lower(name), :q) > 0 OR instr(py_lower(caption), :q) > 0"
+        total = self._scalar(f"SELECT count(*) FROM files WHERE {where}", {"q": q})
+        rows = self._all(
+            f"SELECT code, name, downloads, uploader_name, uploader_role FROM files WHERE {where} "
+            "ORDER BY py_lower(name) = :q DESC, instr(py_lower(name), :q) = 1 DESC, "
+            "instr(py_lower(name), :q) > 0 DESC, downloads DESC LIMIT :lim",
+            {"q": q, "lim": limit},
+        )
+        return rows, total
+
+    async def bot_stats(self, top_n):
+        files, downloads = self._exec(
+            "SELECT count(*), coalesce(sum(downloads), 0) FROM files"
+        ).fetchone()
+        return {
+            "files": files,
+            "downloads": downloads,
+            "users": self._scalar("SELECT count(*) FROM users"),
+            "admins": self._scalar("SELECT count(*) FROM admins"),
+            "top": self._all(
+                "SELECT code, name, downloads, uploader_name, uploader_role FROM files "
+                "ORDER BY downloads DESC LIMIT ?", (top_n,)
+            ),
+        }
+
+    async def uploader_stats(self):
+        return self._all(
+            "SELECT uploaded_by, "
+            "(SELECT f2.uploader_name FROM files f2 WHERE f2.uploaded_by = f.uploaded_by "
+            " ORDER BY f2.created_at DESC LIMIT 1) AS uploader_name, "
+            "count(*) AS files, coalesce(sum(downloads), 0) AS downloads "
+            "FROM files f GROUP BY uploaded_by ORDER BY files DESC"
+        )
+
+    # ── пользователи ──
+    async def upsert_users(self, rows):
+        self._many(
+            "INSERT INTO users (user_id, username, first_name, active) "
+            "VALUES (:user_id, :username, :first_name, :active) "
+            "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, "
+            "first_name = excluded.first_name, active = excluded.active",
+            rows,
+        )
+
+    async def mark_users_inactive(self, user_ids):
+        self._many(
+            "UPDATE users SET active = 0 WHERE user_id = ?", [(uid,) for uid in user_ids]
+        )
+
+    async def active_user_ids(self, after, limit):
+        cur = self._exec(
+            "SELECT user_id FROM users WHERE active AND user_id > ? ORDER BY user_id LIMIT ?",
+            (after, limit),
+        )
+        return array("q", (row[0] for row in cur))
+
+    async def count_users(self, active_only=False):
+        sql = "SELECT count(*) FROM users WHERE active" if active_only else "SELECT count(*) FROM users"
+        return self._scalar(sql)
+
+    # ── рассылки ──
+    async def create_broadcast_job(self, row):
+        cols = ",".join(row)
+        marks = ",".join("?" * len(row))
+        return self._one(
+            f"INSERT INTO broadcast_jobs ({cols}) VALUES ({marks}) RETURNING *", list(row.values())
+        )
+
+    async def get_broadcast_job(self, job_id):
+        return self._one("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,))
+
+    async def get_running_broadcast_jobs(self):
+        return self._all("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+
+    async def update_broadcast_job(self, job_id, fields):
+        fields = {k: v for k, v in fields.items() if k in BROADCAST_JOB_FIELDS}
+        sets = ", ".join(f"{k} = ?" for k in fields)
+        self._exec(
+            f"UPDATE broadcast_jobs SET {sets} WHERE id = ?", [*fields.values(), job_id]
+        )
+
+    async def claim_broadcast_job(self, job_id, from_status, fields, now):
+        fields = {k: v for k, v in fields.items() if k in BROADCAST_JOB_FIELDS}
+        sets = ", ".join(f"{k} = ?" for k in fields)
+        return self._one(
+            f"UPDATE broadcast_jobs SET {sets} WHERE id = ? AND status = ? "
+            "AND (owner IS NULL OR lease_until < ?) RETURNING *",
+            [*fields.values(), job_id, from_status, now],
+        )
+
+    async def save_broadcast_outcomes(self, rows):
+        self._many(
+            "INSERT OR REPLACE INTO broadcast_recipients (job_id, user_id, outcome) "
+            "VALUES (:job_id, :user_id, :outcome)",
+            rows,
+        )
+
+    async def get_broadcast_done_after(self, job_id, cursor):
+        cur = self._exec(
+            "SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND user_id > ?",
+            (job_id, cursor),
+        )
+        return {row[0] for row in cur}
+
+    # ── состояния FSM ──
+    async def get_fsm(self, key):
+        row = self._one("SELECT state, data FROM fsm_states WHERE key = ?", (key,))
+        if row:
+            row["data"] = json.loads(row["data"])
+        return row
+
+    async def save_fsm(self, rows):
+        self._many(
+            "INSERT OR REPLACE INTO fsm_states (key, state, data) VALUES (?, ?, ?)",
+            [(row["key"], row["state"], json.dumps(row["data"], ensure_ascii=False)) for row in rows],
+        )
+
+    async def delete_fsm(self, keys):
+        self._many("DELETE FROM fsm_states WHERE key = ?", [(key,) for key in keys])
+
+
+def make_storage() -> Storage:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_PATH)
+    if STORAGE_BACKEND != "supabase":
+        raise RuntimeError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    if not SUPA_URL or not SUPA_KEY:
+        raise RuntimeError("STORAGE_BACKEND=supabase requires SUPABASE_URL and SUPABASE_KEY")
+    return SupabaseStorage(http)
+
+
+storage = make_storage()
+
+
+# ══════════════════════════════════════════════
+#  КЭШ
+# ══════════════════════════════════════════════
+_MISSING = object()
+
+
+# LRU-кэш в памяти с ограничением размера и временем жизни записей
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=_MISSING):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def peek(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            return default
+        return item[1]
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Второй уровень кэша файлов — локальный SQLite, переживает перезапуск
+class DiskCache:
+    def __init__(self, path: str, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._writes = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, key: str):
+        row = self.conn.execute(
+            "SELECT value FROM entries WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), time.time() + self.ttl),
+        )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+        self.conn.commit()
+
+    def pop(self, key: str):
+        self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self.conn.commit()
+
+    def prune(self):
+        self.conn.execute("DELETE FROM entries WHERE expires <= ?", (time.time(),))
+        self.conn.execute(
+            "DELETE FROM entries WHERE key NOT IN "
+            "(SELECT key FROM entries ORDER BY expires DESC LIMIT ?)",
+            (self.maxsize,),
+        )
+
+    def close(self):
+        self.conn.close()
+
+
+# user_id -> строка из admins (dict) или None для обычных пользователей
+role_cache = TTLCache(ROLE_CACHE_SIZE, ROLE_CACHE_TTL)
+
+# code -> строка из files или None (файла нет, короткий TTL)
+file_cache = TTLCache(FILE_CACHE_SIZE, FILE_CACHE_TTL)
+file_disk_cache: DiskCache | None = None
+
+# code -> сколько скачиваний ещё не записано в БД
+pending_downloads: dict[str, int] = {}
+
+# user_id -> подписан ли на CHANNEL_ID; обновляется апдейтами chat_member
+member_cache = TTLCache(MEMBER_CACHE_SIZE, MEMBER_CACHE_TTL)
+
+# user_id -> (username, first_name), уже записанные в users
+seen_users = TTLCache(USER_SEEN_SIZE, USER_SEEN_TTL)
+# user_id -> строка для пакетного upsert в users
+pending_users: dict[int, dict] = {}
+
+# Полный список банов в памяти; None — ещё не загружен
+banned_ids: set[int] | None = None
+_bans_version = 0
+
+cache_stats = {
+    "updates": 0,
+    "ban_checks": 0,
+    "ban_db_queries": 0,
+    "file_mem_hits": 0,
+    "file_disk_hits": 0,
+    "file_negative_hits": 0,
+    "file_misses": 0,
+}
+
+background_tasks: list[asyncio.Task] = []
 
 # ══════════════════════════════════════════════
 #  РОЛИ
@@ -104,6 +1681,7 @@ OWNER_COMMANDS = SENIOR_COMMANDS + [
     BotCommand(command="sub",    description="Подписка вкл/выкл"),
     BotCommand(command="notify", description="Уведомления вкл/выкл"),
     BotCommand(command="cancel", description="Отмена действия"),
+    BotCommand(command="cache",  description="Статистика кэша"),
 ]
 
 
@@ -168,22 +1746,44 @@ def channels_keyboard(channels: list = None, is_owner: bool = False) -> InlineKe
 # ══════════════════════════════════════════════
 #  ПРОВЕРКА ПОДПИСКИ
 # ══════════════════════════════════════════════
-async def is_subscribed(user_id: int) -> bool:
+async def is_subscribed(user_id: int, role: int = None) -> bool:
     if not sub_required or not CHANNEL_ID:
         return True
-    role = await get_role(user_id)
+    if role is None:
+        role = await get_role(user_id)
     if role >= 1:
         return True
+    cached = member_cache.get(user_id)
+    if cached is not _MISSING:
+        return cached
     try:
         member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        return member.status in (
-            ChatMemberStatus.MEMBER,
-            ChatMemberStatus.ADMINISTRATOR,
-            ChatMemberStatus.CREATOR,
-        )
     except Exception as e:
         logging.error(f"Sub check error: {e}")
         return True
+    set_membership(user_id, member.status)
+    return member_cache.peek(user_id, True)
+
+
+SUBSCRIBED_STATUSES = (
+    ChatMemberStatus.MEMBER,
+    ChatMemberStatus.ADMINISTRATOR,
+    ChatMemberStatus.CREATOR,
+)
+
+
+def set_membership(user_id: int, status):
+    if status in SUBSCRIBED_STATUSES:
+        member_cache.set(user_id, True)
+    else:
+        # Отписанный может подписаться в любой момент — держим недолго
+        member_cache.set(user_id, False, ttl=MEMBER_CACHE_NEG_TTL)
+
+
+def is_sub_channel(chat: types.Chat) -> bool:
+    if str(chat.id) == CHANNEL_ID:
+        return True
+    return bool(chat.username) and f"@{chat.username}".lower() == CHANNEL_ID.lower()
 
 
 # ══════════════════════════════════════════════
@@ -207,188 +1807,914 @@ class PostState(StatesGroup):
     confirm = State()
 
 
-# ══════════════════════════════════════════════
-#  БАЗА ДАННЫХ — админы
-# ══════════════════════════════════════════════
-async def get_role(user_id: int) -> int:
-    if user_id == OWNER_ID:
-        return 4
-    async with http.get(f"{ADMINS_TABLE}?user_id=eq.{user_id}&select=*") as r:
-        data = await r.json()
-        if data:
-            return data[0].get("role", 0)
-        return 0
+# FSM в хранилище. set_state/set_data меняют только запись в памяти,
+# flush раз в FSM_FLUSH_SEC пишет одну строку на ключ: шаг /post
+# (update_data + set_state) — не больше одной записи, а не две.
+# Чтение — из LRU на FSM_CACHE_SIZE ключей; несброшенные записи лежат
+# в dirty и из кэша не вытесняются. Пустое состояние тоже кэшируется,
+# чтобы проверка фильтров по состоянию не ходила в базу на каждое сообщение.
+class DbFSMStorage(BaseStorage):
+    def __init__(self, store: Storage, cache_size: int, cache_ttl: float):
+        self.store = store
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.dirty: dict[str, tuple[str | None, dict]] = {}
+        self.writes = 0
+        self.coalesced = 0
+
+    async def _load(self, key: StorageKey) -> tuple[str, tuple[str | None, dict]]:
+        k = self.key_builder.build(key)
+        record = self.dirty.get(k) or self.cache.get(k, None)
+        if record is None:
+            row = await self.store.get_fsm(k)
+            record = (row["state"], row["data"] or {}) if row else (None, {})
+            # Пока шёл запрос, запись могла измениться
+            record = self.dirty.get(k, record)
+            self.cache.set(k, record)
+        return k, record
+
+    def _put(self, k: str, old: tuple[str | None, dict], record: tuple[str | None, dict]):
+        # state.clear() для пустой записи — частый случай в /start, не пишем
+        if record == old:
+            return
+        if k in self.dirty:
+            self.coalesced += 1
+        self.dirty[k] = record
+        self.cache.set(k, record)
+        # Запись в базу отложена — остальные воркеры получают состояние сразу
+        bus.publish("fsm", key=k, state=record[0], data=record[1])
+
+    # Состояние, изменённое в другом воркере: его запись новее нашей
+    def apply(self, k: str, record: tuple[str | None, dict]):
+        self.dirty.pop(k, None)
+        self.cache.set(k, record)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, old = await self._load(key)
+        self._put(k, old, (state.state if isinstance(state, State) else state, old[1]))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        _, (state, _) = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        k, old = await self._load(key)
+        self._put(k, old, (old[0], data.copy()))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        _, (_, data) = await self._load(key)
+        return data.copy()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        rows = [{"key": k, "state": state, "data": data}
+                for k, (state, data) in batch.items() if state is not None or data]
+        cleared = [k for k, (state, data) in batch.items() if state is None and not data]
+        try:
+            if rows:
+                await self.store.save_fsm(rows)
+            if cleared:
+                await self.store.delete_fsm(cleared)
+            self.writes += len(batch)
+        except Exception as e:
+            logging.error(f"FSM flush: {e}")
+            for k, record in batch.items():
+                self.dirty.setdefault(k, record)
+
+    async def close(self) -> None:
+        await self.flush()
+
+
+def make_fsm_storage() -> BaseStorage:
+    if FSM_BACKEND == "db":
+        return DbFSMStorage(storage, FSM_CACHE_SIZE, FSM_CACHE_TTL)
+    if FSM_BACKEND != "memory":
+        raise RuntimeError(f"Unknown FSM_BACKEND: {FSM_BACKEND}")
+    return MemoryStorage()
+
+
+fsm_storage = make_fsm_storage()
+
+
+async def fsm_flush_loop():
+    while True:
+        await asyncio.sleep(FSM_FLUSH_SEC)
+        await fsm_storage.flush()
+
+
+# ══════════════════════════════════════════════
+#  КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ
+# ══════════════════════════════════════════════
+# Роль и бан автора апдейта — один раз на апдейт.
+# Сначала из кэшей; если чего-то не хватает — один запрос get_user_context,
+# который заодно заполняет role_cache.
+class UserContext:
+    __slots__ = ("user_id", "role", "banned")
+
+    def __init__(self, user_id: int, role: int, banned: bool):
+        self.user_id = user_id
+        self.role = role
+        self.banned = banned
+
+
+async def resolve_user_context(user_id: int) -> UserContext:
+    if user_id == OWNER_ID:
+        return UserContext(user_id, 4, False)
+    cache_stats["ban_checks"] += 1
+    info = role_cache.get(user_id)
+    if info is not _MISSING and banned_ids is not None:
+        return UserContext(user_id, info.get("role", 0) if info else 0, user_id in banned_ids)
+
+    row = await storage.get_user_context(user_id)
+    info = row.get("admin")
+    role_cache.set(user_id, info)
+    if banned_ids is not None:
+        banned = user_id in banned_ids
+    else:
+        cache_stats["ban_db_queries"] += 1
+        banned = bool(row.get("banned"))
+    return UserContext(user_id, info.get("role", 0) if info else 0, banned)
+
+
+# ══════════════════════════════════════════════
+#  БАЗА ДАННЫХ — админы
+# ══════════════════════════════════════════════
+async def get_role(user_id: int) -> int:
+    if user_id == OWNER_ID:
+        return 4
+    info = await get_admin_info(user_id)
+    if info:
+        return info.get("role", 0)
+    return 0
+
+
+async def get_admin_info(user_id: int) -> dict | None:
+    if user_id == OWNER_ID:
+        return {"user_id": OWNER_ID, "role": 4, "username": "owner"}
+    cached = role_cache.get(user_id)
+    if cached is not _MISSING:
+        return cached
+    info = await storage.get_admin(user_id)
+    role_cache.set(user_id, info)
+    return info
+
+
+async def set_admin(user_id: int, role: int, username: str):
+    existing = await get_admin_info(user_id)
+    if existing and user_id != OWNER_ID:
+        await storage.update_admin(user_id, role, username)
+    else:
+        await storage.insert_admin(user_id, role, username)
+    row = {"user_id": user_id, "role": role, "username": username}
+    role_cache.set(user_id, row)
+    bus.publish("role", user_id=user_id, admin=row)
+    invalidate_stats()
+    await update_user_commands(user_id, role)
+
+
+async def remove_admin(user_id: int):
+    await storage.delete_admin(user_id)
+    role_cache.set(user_id, None)
+    bus.publish("role", user_id=user_id, admin=None)
+    invalidate_stats()
+    await update_user_commands(user_id, 0)
+
+
+async def get_roles(user_ids) -> dict[int, int]:
+    roles = {}
+    missing = []
+    for uid in set(user_ids):
+        if uid == OWNER_ID:
+            roles[uid] = 4
+            continue
+        cached = role_cache.get(uid)
+        if cached is _MISSING:
+            missing.append(uid)
+        else:
+            roles[uid] = cached.get("role", 0) if cached else 0
+    if missing:
+        rows = await storage.get_admins(missing)
+        found = {row["user_id"]: row for row in rows}
+        for uid in missing:
+            info = found.get(uid)
+            role_cache.set(uid, info)
+            roles[uid] = info.get("role", 0) if info else 0
+    return roles
+
+
+async def get_all_admins():
+    return await storage.get_all_admins()
+
+
+async def load_roles():
+    admins = await get_all_admins()
+    for admin in admins:
+        role_cache.set(admin["user_id"], admin)
+    logging.info(f"Role cache: {len(admins)} admins preloaded")
+
+
+# ══════════════════════════════════════════════
+#  БАЗА ДАННЫХ — баны
+# ══════════════════════════════════════════════
+async def is_banned(user_id: int) -> bool:
+    cache_stats["ban_checks"] += 1
+    if banned_ids is not None:
+        return user_id in banned_ids
+    cache_stats["ban_db_queries"] += 1
+    return await storage.is_banned(user_id)
+
+
+async def add_ban(user_id: int, reason: str, banned_by: int):
+    global _bans_version
+    await storage.add_ban(user_id, reason, banned_by)
+    _bans_version += 1
+    if banned_ids is not None:
+        banned_ids.add(user_id)
+    bus.publish("ban", user_id=user_id, banned=True)
+
+
+async def remove_ban(user_id: int):
+    global _bans_version
+    await storage.remove_ban(user_id)
+    _bans_version += 1
+    if banned_ids is not None:
+        banned_ids.discard(user_id)
+    bus.publish("ban", user_id=user_id, banned=False)
+
+
+async def load_bans():
+    global banned_ids
+    version = _bans_version
+    ids = await storage.get_banned_ids()
+    # Пока шёл запрос, /ban или /unban уже изменили множество — ждём следующего цикла
+    if version != _bans_version and banned_ids is not None:
+        return
+    banned_ids = set(ids)
+
+
+async def bans_refresh_loop():
+    while True:
+        await asyncio.sleep(BAN_REFRESH_SEC)
+        try:
+            await load_bans()
+        except Exception as e:
+            logging.error(f"Bans refresh error: {e}")
+
+
+# ══════════════════════════════════════════════
+#  БАЗА ДАННЫХ — каналы (где бот админ)
+# ══════════════════════════════════════════════
+async def save_channel(chat_id: int, title: str):
+    await storage.save_channel(chat_id, title)
+
+
+async def remove_channel(chat_id: int):
+    await storage.remove_channel(chat_id)
+
+
+async def get_all_channels():
+    try:
+        return await storage.get_all_channels()
+    except Exception:
+        return []
+
+
+# ══════════════════════════════════════════════
+#  БАЗА ДАННЫХ — настройки (/sub, /notify)
+# ══════════════════════════════════════════════
+# Переключатели хранятся в базе: переживают перезапуск и одинаковы во всех воркерах
+def apply_setting(name: str, value):
+    global sub_required, notify_uploads
+    if name == "sub_required":
+        sub_required = bool(value)
+    elif name == "notify_uploads":
+        notify_uploads = bool(value)
+
+
+async def set_setting(name: str, value):
+    await storage.save_setting(name, value)
+    apply_setting(name, value)
+    bus.publish("setting", name=name, value=value)
+
+
+async def load_settings():
+    try:
+        saved = await storage.get_settings()
+    except StorageError as e:
+        logging.error(f"Settings load: {e}")
+        return
+    for name, value in saved.items():
+        apply_setting(name, value)
+
+
+# ══════════════════════════════════════════════
+#  БАЗА ДАННЫХ — файлы
+# ══════════════════════════════════════════════
+def open_file_disk_cache():
+    global file_disk_cache
+    if not FILE_DISK_CACHE:
+        return
+    try:
+        file_disk_cache = DiskCache(FILE_DISK_CACHE, FILE_DISK_CACHE_SIZE, FILE_DISK_CACHE_TTL)
+    except Exception as e:
+        logging.error(f"Disk cache disabled: {e}")
+        file_disk_cache = None
+
+
+def invalidate_file(code: str):
+    file_cache.pop(code)
+    if file_disk_cache:
+        try:
+            file_disk_cache.pop(code)
+        except Exception as e:
+            logging.error(f"Disk cache pop: {e}")
+
+
+async def db_get(code: str):
+    cached = file_cache.get(code)
+    if cached is not _MISSING:
+        cache_stats["file_mem_hits" if cached else "file_negative_hits"] += 1
+        return cached
+
+    if file_disk_cache:
+        try:
+            entry = file_disk_cache.get(code)
+        except Exception as e:
+            logging.error(f"Disk cache get: {e}")
+            entry = None
+        if entry:
+            cache_stats["file_disk_hits"] += 1
+            file_cache.set(code, entry)
+            return entry
+
+    cache_stats["file_misses"] += 1
+    entry = await storage.get_file(code)
+
+    if entry:
+        file_cache.set(code, entry)
+        if file_disk_cache:
+            try:
+                file_disk_cache.set(code, entry)
+            except Exception as e:
+                logging.error(f"Disk cache set: {e}")
+    else:
+        file_cache.set(code, None, ttl=FILE_CACHE_NEG_TTL)
+    return entry
+
+
+async def db_save(code: str, entry: dict):
+    row = {"code": code}
+    row.update(entry)
+    await storage.insert_file(row)
+    invalidate_file(code)
+    search_index.add(row)
+    bus.publish("file_add", row=row)
+    if stats_snapshot:
+        stats_snapshot["files"] += 1
+
+
+async def db_delete(code: str):
+    await storage.delete_file(code)
+    invalidate_file(code)
+    search_index.remove(code)
+    invalidate_stats()
+    bus.publish("file_delete", code=code)
+
+
+async def db_page(uploaded_by: int = None, cursor: tuple = None,
+                  backward: bool = False, limit: int = FILE_PAGE_SIZE):
+    # Keyset-пагинация по (created_at, code), новые сверху.
+    # cursor — (created_at, code) крайней записи соседней страницы.
+    rows = await storage.files_page(uploaded_by, cursor, backward, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+def db_increment(code: str):
+    pending_downloads[code] = pending_downloads.get(code, 0) + 1
+
+
+def downloads_of(entry: dict) -> int:
+    return (entry.get("downloads") or 0) + pending_downloads.get(entry.get("code"), 0)
+
+
+async def flush_downloads():
+    global pending_downloads
+    if not pending_downloads:
+        return
+    batch, pending_downloads = pending_downloads, {}
+    try:
+        await storage.increment_downloads(batch)
+    except Exception as e:
+        logging.error(f"Downloads flush: {e}")
+        # Возвращаем счётчики в буфер, чтобы не потерять скачивания
+        for code, delta in batch.items():
+            pending_downloads[code] = pending_downloads.get(code, 0) + delta
+        return
+
+    if stats_snapshot:
+        stats_snapshot["downloads"] += sum(batch.values())
+        for top in stats_snapshot["top"]:
+            top["downloads"] = (top.get("downloads") or 0) + batch.get(top["code"], 0)
+        stats_snapshot["top"].sort(key=lambda x: x.get("downloads") or 0, reverse=True)
+
+    for code, delta in batch.items():
+        search_index.add_downloads(code, delta)
+        cached = file_cache.peek(code)
+        if cached:
+            cached["downloads"] = (cached.get("downloads") or 0) + delta
+        if file_disk_cache:
+            try:
+                if cached:
+                    file_disk_cache.set(code, cached)
+                else:
+                    file_disk_cache.pop(code)
+            except Exception as e:
+                logging.error(f"Disk cache update: {e}")
+
+
+async def downloads_flush_loop():
+    while True:
+        await asyncio.sleep(DOWNLOADS_FLUSH_SEC)
+        await flush_downloads()
+
+
+async def db_rename(code: str, new_name: str):
+    await storage.rename_file(code, new_name)
+    invalidate_file(code)
+    search_index.rename(code, new_name)
+    bus.publish("file_rename", code=code, name=new_name)
+
+
+# ══════════════════════════════════════════════
+#  ПОИСК
+# ══════════════════════════════════════════════
+# Триграммный инвертированный индекс по name + caption.
+# Кандидаты берутся из самого короткого списка триграмм запроса и
+# проверяются подстрокой, поэтому результат совпадает со старым /find.
+class SearchIndex:
+    def __init__(self):
+        self.ready = False
+        # Коды, изменённые пока индекс загружается, — строки из загрузки для них устарели
+        self._touched: set[str] = set()
+        self._reset()
+
+    def _reset(self):
+        # doc_id -> (code, name, downloads, uploader_name, uploader_role, caption)
+        self._rows: list[tuple | None] = []
+        self._texts: list[str] = []
+        self._ids: dict[str, int] = {}         # code -> doc_id
+        self._grams: dict[str, array] = {}
+        self._dead = 0
+
+    @staticmethod
+    def _trigrams(text: str) -> set[str]:
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, row: dict, loading: bool = False):
+        code = row["code"]
+        if loading:
+            if code in self._touched:
+                return
+        elif not self.ready:
+            self._touched.add(code)
+        self.remove(code)
+        name = row.get("name") or ""
+        caption = row.get("caption") or ""
+        text = f"{name.lower()}\n{caption.lower()}"
+        doc_id = len(self._rows)
+        self._rows.append((
+            code, name, row.get("downloads") or 0,
+            row.get("uploader_name", "?"), row.get("uploader_role") or 0, caption,
+        ))
+        self._texts.append(text)
+        self._ids[code] = doc_id
+        for gram in self._trigrams(text):
+            posting = self._grams.get(gram)
+            if posting is None:
+                posting = self._grams[gram] = array("I")
+            posting.append(doc_id)
+
+    def remove(self, code: str):
+        if not self.ready:
+            self._touched.add(code)
+        doc_id = self._ids.pop(code, None)
+        if doc_id is None:
+            return
+        self._rows[doc_id] = None
+        self._texts[doc_id] = ""
+        self._dead += 1
+        if self._dead > 1000 and self._dead > len(self._ids):
+            self._compact()
+
+    def rename(self, code: str, new_name: str):
+        doc_id = self._ids.get(code)
+        if doc_id is None:
+            return
+        # Подпись берём из строки, а не из текста: в имени может быть перевод строки
+        code, _, downloads, uploader_name, uploader_role, caption = self._rows[doc_id]
+        self.add({
+            "code": code, "name": new_name, "caption": caption, "downloads": downloads,
+            "uploader_name": uploader_name, "uploader_role": uploader_role,
+        })
+
+    def add_downloads(self, code: str, delta: int):
+        doc_id = self._ids.get(code)
+        if doc_id is not None:
+            code, name, downloads, uploader_name, uploader_role, caption = self._rows[doc_id]
+            self._rows[doc_id] = (code, name, downloads + delta, uploader_name, uploader_role, caption)
+
+    def _compact(self):
+        docs = [row for row in self._rows if row is not None]
+        touched, self._touched = self._touched, set()
+        self._reset()
+        for code, name, downloads, uploader_name, uploader_role, caption in docs:
+            self.add({
+                "code": code, "name": name, "caption": caption,
+                "downloads": downloads, "uploader_name": uploader_name,
+                "uploader_role": uploader_role,
+            }, loading=True)
+        self._touched = touched
+
+    def finish_loading(self):
+        self.ready = True
+        self._touched.clear()
+
+    # До следующей загрузки поиск идёт через search_files_remote
+    def clear(self):
+        self.ready = False
+        self._touched.clear()
+        self._reset()
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> tuple[list[dict], int]:
+        q = query.lower()
+        if len(q) >= 3:
+            postings = [self._grams.get(g) for g in self._trigrams(q)]
+            if any(p is None for p in postings):
+                return [], 0
+            candidates = min(postings, key=len)
+        else:
+            candidates = range(len(self._rows))
+
+        found = []
+        for doc_id in candidates:
+            row = self._rows[doc_id]
+            if row is None or q not in self._texts[doc_id]:
+                continue
+            name = row[1].lower()
+            # Ранжирование: точное имя > начало имени > имя содержит > только подпись, затем скачивания
+            found.append(((name == q, name.startswith(q), q in name, row[2]), doc_id))
+
+        top = heapq.nlargest(limit, found)
+        results = []
+        for _, doc_id in top:
+            code, name, downloads, uploader_name, uploader_role, _ = self._rows[doc_id]
+            results.append({
+                "code": code, "name": name, "downloads": downloads,
+                "uploader_name": uploader_name, "uploader_role": uploader_role,
+            })
+        return results, len(found)
+
+
+search_index = SearchIndex()
+
+
+async def load_search_index(page_size: int = 1000):
+    last_code = ""
+    while True:
+        rows = await storage.scan_files(last_code, page_size)
+        for row in rows:
+            search_index.add(row, loading=True)
+        if len(rows) < page_size:
+            break
+        last_code = rows[-1]["code"]
+    search_index.finish_loading()
+    logging.info(f"Search index: {len(search_index)} files")
+
+
+async def load_search_index_safe():
+    try:
+        await load_search_index()
+    except Exception as e:
+        logging.error(f"Search index load: {e}")
+
+
+async def search_files_remote(query: str, limit: int = SEARCH_LIMIT) -> tuple[list[dict], int]:
+    return await storage.search_files(query, limit)
+
 
+async def search_files(query: str, limit: int = SEARCH_LIMIT) -> tuple[list[dict], int]:
+    if SEARCH_BACKEND == "index" and search_index.ready:
+        return search_index.search(query, limit)
+    return await search_files_remote(query, limit)
 
-async def get_admin_info(user_id: int) -> dict | None:
-    if user_id == OWNER_ID:
-        return {"user_id": OWNER_ID, "role": 4, "username": "owner"}
-    async with http.get(f"{ADMINS_TABLE}?user_id=eq.{user_id}&select=*") as r:
-        data = await r.json()
-        return data[0] if data else None
 
+# ══════════════════════════════════════════════
+#  БАЗА ДАННЫХ — пользователи
+# ══════════════════════════════════════════════
+def save_user(user: types.User):
+    username, first_name = user.username or "", user.first_name or ""
+    if seen_users.get(user.id) == (username, first_name):
+        return
+    seen_users.set(user.id, (username, first_name))
+    pending_users[user.id] = {
+        "user_id": user.id, "username": username,
+        "first_name": first_name, "active": True,
+    }
 
-async def set_admin(user_id: int, role: int, username: str):
-    existing = await get_admin_info(user_id)
-    if existing and user_id != OWNER_ID:
-        async with http.patch(
-            f"{ADMINS_TABLE}?user_id=eq.{user_id}",
-            json={"role": role, "username": username}
-        ) as r:
-            pass
-    else:
-        async with http.post(
-            ADMINS_TABLE,
-            json={"user_id": user_id, "role": role, "username": username},
-            headers={"Prefer": "return=minimal"}
-        ) as r:
-            pass
-    await update_user_commands(user_id, role)
 
+async def flush_users():
+    global pending_users
+    if not pending_users:
+        return
+    batch, pending_users = pending_users, {}
+    try:
+        await storage.upsert_users(list(batch.values()))
+    except Exception as e:
+        logging.error(f"Users flush: {e}")
+        # Более свежие строки, пришедшие во время запроса, не затираем
+        for uid, row in batch.items():
+            pending_users.setdefault(uid, row)
 
-async def remove_admin(user_id: int):
-    async with http.delete(f"{ADMINS_TABLE}?user_id=eq.{user_id}") as r:
-        pass
-    await update_user_commands(user_id, 0)
 
+async def users_flush_loop():
+    while True:
+        await asyncio.sleep(USERS_FLUSH_SEC)
+        await flush_users()
 
-async def get_all_admins():
-    async with http.get(f"{ADMINS_TABLE}?select=*&order=role.desc") as r:
-        return await r.json()
 
+# Пользователи, заблокировавшие бота или удалившие аккаунт, — рассылки их пропускают
+async def mark_users_inactive(user_ids: list[int]):
+    for uid in user_ids:
+        # Следующий /start должен снова записать active = true
+        seen_users.pop(uid)
+    await storage.mark_users_inactive(user_ids)
+    # Последний /start мог прийти в другой воркер — его seen_users тоже сбрасываем
+    for i in range(0, len(user_ids), 1000):
+        bus.publish("user_inactive", user_ids=user_ids[i:i + 1000])
 
-# ══════════════════════════════════════════════
-#  БАЗА ДАННЫХ — баны
-# ══════════════════════════════════════════════
-async def is_banned(user_id: int) -> bool:
-    async with http.get(f"{BANS_TABLE}?user_id=eq.{user_id}&select=user_id") as r:
-        data = await r.json()
-        return len(data) > 0
 
+async def fetch_user_ids(after: int, limit: int) -> array:
+    return await storage.active_user_ids(after, limit)
 
-async def add_ban(user_id: int, reason: str, banned_by: int):
-    async with http.post(
-        BANS_TABLE,
-        json={"user_id": user_id, "reason": reason, "banned_by": banned_by},
-        headers={"Prefer": "return=minimal"}
-    ) as r:
-        pass
 
+# Страницы user_id по возрастанию; следующая страница грузится,
+# пока отправляется текущая
+async def iter_user_id_pages(after: int = 0, page_size: int = USERS_PAGE_SIZE):
+    next_page = asyncio.create_task(fetch_user_ids(after, page_size))
+    try:
+        while next_page:
+            page = await next_page
+            next_page = None
+            if len(page) == page_size:
+                next_page = asyncio.create_task(fetch_user_ids(page[-1], page_size))
+            if page:
+                yield page
+    finally:
+        if next_page:
+            next_page.cancel()
 
-async def remove_ban(user_id: int):
-    async with http.delete(f"{BANS_TABLE}?user_id=eq.{user_id}") as r:
-        pass
+
+async def count_users(active_only: bool = False):
+    return await storage.count_users(active_only)
 
 
 # ══════════════════════════════════════════════
-#  БАЗА ДАННЫХ — каналы (где бот админ)
+#  БАЗА ДАННЫХ — рассылки
 # ══════════════════════════════════════════════
-async def save_channel(chat_id: int, title: str):
-    async with http.post(
-        CHANNELS_TABLE,
-        json={"chat_id": chat_id, "title": title},
-        headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
-    ) as r:
-        if r.status >= 400:
-            async with http.patch(
-                f"{CHANNELS_TABLE}?chat_id=eq.{chat_id}",
-                json={"title": title},
-            ) as r2:
-                pass
+async def create_broadcast_job(row: dict) -> dict:
+    return await storage.create_broadcast_job(row)
 
 
-async def remove_channel(chat_id: int):
-    async with http.delete(f"{CHANNELS_TABLE}?chat_id=eq.{chat_id}") as r:
-        pass
+async def get_broadcast_job(job_id: int) -> dict | None:
+    return await storage.get_broadcast_job(job_id)
 
 
-async def get_all_channels():
+async def get_running_broadcast_jobs() -> list[dict]:
+    return await storage.get_running_broadcast_jobs()
+
+
+async def update_broadcast_job(job_id: int, fields: dict):
     try:
-        async with http.get(f"{CHANNELS_TABLE}?select=*&order=title.asc") as r:
-            data = await r.json()
-            return data if isinstance(data, list) else []
-    except Exception:
-        return []
+        await storage.update_broadcast_job(job_id, fields)
+    except StorageError as e:
+        logging.error(f"Broadcast job update: {e}")
 
 
-# ══════════════════════════════════════════════
-#  БАЗА ДАННЫХ — файлы
-# ══════════════════════════════════════════════
-async def db_get(code: str):
-    async with http.get(f"{FILES_TABLE}?code=eq.{code}&select=*") as r:
-        data = await r.json()
-        return data[0] if data else None
+async def claim_broadcast_job(job_id: int, from_status: str, fields: dict) -> dict | None:
+    return await storage.claim_broadcast_job(job_id, from_status, fields, time.time())
 
 
-async def db_save(code: str, entry: dict):
-    row = {"code": code}
-    row.update(entry)
-    async with http.post(FILES_TABLE, json=row, headers={"Prefer": "return=minimal"}) as r:
-        if r.status >= 400:
-            text = await r.text()
-            logging.error(f"DB save: {r.status} {text}")
+async def save_broadcast_outcomes(rows: list[dict]):
+    await storage.save_broadcast_outcomes(rows)
 
 
-async def db_delete(code: str):
-    async with http.delete(f"{FILES_TABLE}?code=eq.{code}") as r:
-        pass
+# Получатели после курсора, уже обработанные вне очереди до остановки
+async def get_broadcast_done_after(job_id: int, cursor: int) -> set[int]:
+    return await storage.get_broadcast_done_after(job_id, cursor)
 
 
-async def db_all():
-    async with http.get(f"{FILES_TABLE}?select=*&order=created_at.desc") as r:
-        return await r.json()
+# ══════════════════════════════════════════════
+#  БАЗА ДАННЫХ — статистика
+# ══════════════════════════════════════════════
+# Снимок агрегатов из RPC bot_stats: files, downloads, users, admins, top.
+# Между перезагрузками поддерживается инкрементально (новые файлы, скачивания).
+stats_snapshot: dict | None = None
+stats_loaded_at = 0.0
 
 
-async def db_increment(code: str, current: int):
-    async with http.patch(
-        f"{FILES_TABLE}?code=eq.{code}",
-        json={"downloads": current + 1}
-    ) as r:
-        pass
+def invalidate_stats():
+    global stats_snapshot
+    stats_snapshot = None
 
 
-async def db_rename(code: str, new_name: str):
-    async with http.patch(
-        f"{FILES_TABLE}?code=eq.{code}",
-        json={"name": new_name}
-    ) as r:
-        pass
+async def get_stats() -> dict:
+    global stats_snapshot, stats_loaded_at
+    if stats_snapshot is None or time.monotonic() - stats_loaded_at > STATS_TTL:
+        data = await storage.bot_stats(STATS_TOP_N)
+        data["top"] = data.get("top") or []
+        stats_snapshot = data
+        stats_loaded_at = time.monotonic()
+    pending = sum(pending_downloads.values())
+    return {**stats_snapshot, "downloads": stats_snapshot["downloads"] + pending}
+
+
+# Файлы и скачивания по загрузившим, уже сгруппированные в базе
+async def get_uploader_stats() -> list[dict]:
+    return await storage.uploader_stats()
 
 
 # ══════════════════════════════════════════════
-#  БАЗА ДАННЫХ — пользователи
+#  ШИНА ИНВАЛИДАЦИИ
 # ══════════════════════════════════════════════
-async def save_user(user: types.User):
-    async with http.post(
-        USERS_TABLE,
-        json={"user_id": user.id, "username": user.username or "", "first_name": user.first_name or ""},
-        headers={"Prefer": "return=minimal", "on-conflict": "user_id"}
-    ) as r:
-        if r.status == 409:
-            async with http.patch(
-                f"{USERS_TABLE}?user_id=eq.{user.id}",
-                json={"username": user.username or "", "first_name": user.first_name or ""}
-            ) as r2:
+# При WORKERS > 1 каждая запись (роль, бан, файл, FSM) сразу рассылается
+# остальным воркерам датаграммой через unix-сокет BUS_DIR/filesbot-<PORT>-<n>.sock.
+# У отправителя свой счётчик seq и epoch (pid): пропущенный номер или
+# heartbeat с seq больше последнего принятого — сброс кэшей и перезагрузка из базы.
+class InvalidationBus(asyncio.DatagramProtocol):
+    def __init__(self, workers: int, directory: str):
+        self.paths = [os.path.join(directory, f"filesbot-{PORT}-{i}.sock") for i in range(workers)]
+        self.worker = 0
+        self.epoch = os.getpid()
+        self.seq = 0
+        self.seen: dict[int, tuple[int, int]] = {}   # worker -> (epoch, seq)
+        self.transport: asyncio.DatagramTransport | None = None
+        self.resync_task: asyncio.Task | None = None
+        self.published = 0
+        self.received = 0
+        self.send_errors = 0
+        self.resyncs = 0
+
+    @property
+    def active(self) -> bool:
+        return self.transport is not None
+
+    async def start(self, worker: int):
+        self.worker = worker
+        path = self.paths[worker]
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: self, local_addr=path, family=socket.AF_UNIX,
+        )
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+            try:
+                os.unlink(self.paths[self.worker])
+            except FileNotFoundError:
                 pass
 
+    def _send(self, message: dict):
+        data = json.dumps(message, ensure_ascii=False).encode()
+        for i, path in enumerate(self.paths):
+            if i != self.worker:
+                self.transport.sendto(data, path)
 
-async def get_all_users():
-    async with http.get(f"{USERS_TABLE}?select=user_id") as r:
-        rows = await r.json()
-        return [row["user_id"] for row in rows]
+    def publish(self, kind: str, **data):
+        if not self.transport:
+            return
+        self.seq += 1
+        self.published += 1
+        self._send({"src": self.worker, "epoch": self.epoch, "seq": self.seq, "kind": kind, "data": data})
 
+    def heartbeat(self):
+        if self.transport:
+            self._send({"src": self.worker, "epoch": self.epoch, "seq": self.seq, "kind": "ping"})
 
-async def count_users():
-    async with http.get(
-        f"{USERS_TABLE}?select=user_id",
-        headers={"Prefer": "count=exact"}
-    ) as r:
-        cr = r.headers.get("content-range", "")
+    def datagram_received(self, data: bytes, addr):
         try:
-            return int(cr.split("/")[1])
-        except Exception:
-            data = await r.json()
-            return len(data)
+            message = json.loads(data)
+            src, epoch, seq, kind = message["src"], message["epoch"], message["seq"], message["kind"]
+        except (ValueError, KeyError) as e:
+            logging.error(f"Bus: bad message: {e}")
+            return
+        last = self.seen.get(src)
+        if last is None or last[0] != epoch:
+            # Новый процесс: события до нашего старта уже в базе
+            expected = seq if kind == "ping" else max(seq - 1, 0)
+        else:
+            expected = last[1]
+        self.seen[src] = (epoch, max(seq, expected))
+        if kind != "ping":
+            self.received += 1
+            try:
+                apply_bus_event(kind, message.get("data") or {})
+            except Exception as e:
+                logging.error(f"Bus: {kind}: {e}")
+            expected += 1
+        if seq > expected:
+            logging.warning(f"Bus: worker {src} is at seq {seq}, expected {expected}; resyncing")
+            self.resync()
+
+    def error_received(self, exc):
+        # Воркер перезапускается: его кэши и так начнутся с чистого листа
+        self.send_errors += 1
+
+    def resync(self):
+        if self.resync_task and not self.resync_task.done():
+            return
+        self.resyncs += 1
+        self.resync_task = asyncio.create_task(resync_caches())
+
+
+def apply_bus_event(kind: str, data: dict):
+    global _bans_version
+    if kind == "role":
+        role_cache.set(data["user_id"], data["admin"])
+        invalidate_stats()
+    elif kind == "ban":
+        _bans_version += 1
+        if banned_ids is not None:
+            if data["banned"]:
+                banned_ids.add(data["user_id"])
+            else:
+                banned_ids.discard(data["user_id"])
+    elif kind == "file_add":
+        row = data["row"]
+        file_cache.pop(row["code"])
+        search_index.add(row)
+        invalidate_stats()
+    elif kind == "file_delete":
+        file_cache.pop(data["code"])
+        search_index.remove(data["code"])
+        invalidate_stats()
+    elif kind == "file_rename":
+        file_cache.pop(data["code"])
+        search_index.rename(data["code"], data["name"])
+    elif kind == "fsm":
+        if isinstance(fsm_storage, DbFSMStorage):
+            fsm_storage.apply(data["key"], (data["state"], data["data"]))
+    elif kind == "user_inactive":
+        for uid in data["user_ids"]:
+            seen_users.pop(uid)
+    elif kind == "setting":
+        apply_setting(data["name"], data["value"])
+    elif kind == "broadcast":
+        job = broadcast_jobs.get(data["job_id"])
+        if job and data["action"] in ("paused", "cancelled"):
+            job.state = data["action"]
+    else:
+        logging.warning(f"Bus: unknown event {kind}")
+
+
+# Событие потеряно — всё, что могло устареть, перечитываем из базы
+async def resync_caches():
+    role_cache.clear()
+    file_cache.clear()
+    if isinstance(fsm_storage, DbFSMStorage):
+        fsm_storage.cache.clear()
+    invalidate_stats()
+    try:
+        await load_roles()
+        await load_bans()
+        await load_settings()
+        if SEARCH_BACKEND == "index":
+            search_index.clear()
+            await load_search_index()
+    except Exception as e:
+        logging.error(f"Bus resync: {e}")
+
+
+async def bus_heartbeat_loop():
+    while True:
+        await asyncio.sleep(BUS_HEARTBEAT_SEC)
+        bus.heartbeat()
+
+
+bus = InvalidationBus(WORKERS, BUS_DIR)
 
 
 # ══════════════════════════════════════════════
@@ -574,18 +2900,23 @@ async def send_post_preview(message: types.Message, data: dict):
 # ══════════════════════════════════════════════
 #  БОТ
 # ══════════════════════════════════════════════
-bot    = Bot(token=TOKEN)
-dp     = Dispatcher()
+bot    = Bot(
+    token=TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
+dp     = Dispatcher(storage=fsm_storage)
 router = Router()
+bot.session.middleware(telegram_metrics)
+bot.session.middleware(trace_telegram)
 
 
 # ────────── /start ──────────
 @router.message(CommandStart())
-async def cmd_start(msg: types.Message, state: FSMContext):
-    await save_user(msg.from_user)
+async def cmd_start(msg: types.Message, state: FSMContext, user_ctx: UserContext):
+    save_user(msg.from_user)
     await state.clear()
 
-    if await is_banned(msg.from_user.id):
+    if user_ctx.banned:
         return await msg.answer("🚫 Вы заблокированы.")
 
     args = msg.text.split(maxsplit=1)
@@ -596,7 +2927,7 @@ async def cmd_start(msg: types.Message, state: FSMContext):
         if not entry:
             return await msg.answer("❌ Файл не найден.")
 
-        if not await is_subscribed(msg.from_user.id):
+        if not await is_subscribed(msg.from_user.id, user_ctx.role):
             return await msg.answer(
                 "🔒 <b>Чтобы продолжить, подпишитесь на канал</b>\n\n"
                 "После подписки нажмите «✅ Я подписался»",
@@ -604,7 +2935,7 @@ async def cmd_start(msg: types.Message, state: FSMContext):
                 reply_markup=sub_keyboard(code),
             )
 
-        await db_increment(code, entry.get("downloads") or 0)
+        db_increment(code)
         try:
             await send_file(msg, entry)
         except Exception as e:
@@ -612,20 +2943,19 @@ async def cmd_start(msg: types.Message, state: FSMContext):
             await msg.answer("❌ Не удалось отправить файл.")
         return
 
-    role = await get_role(msg.from_user.id)
+    role = user_ctx.role
     username = get_username_display(msg.from_user)
 
     if role >= 1:
-        users = await count_users()
-        rows = await db_all()
+        stats = await get_stats()
         sub_status = "✅ ВКЛ" if sub_required else "❌ ВЫКЛ"
         notify_status = "✅ ВКЛ" if notify_uploads else "❌ ВЫКЛ"
 
         text = (
             f"👋 <b>Приветствую, {username}, в боте для выдачи файлов!</b>\n\n"
             f"<b>Ваша роль:</b> {ROLES[role]}\n\n"
-            f"📂 Файлов: <b>{len(rows)}</b>\n"
-            f"👥 Пользователей: <b>{users}</b>\n"
+            f"📂 Файлов: <b>{stats['files']}</b>\n"
+            f"👥 Пользователей: <b>{stats['users']}</b>\n"
             f"📢 Подписка: <b>{sub_status}</b>\n"
             f"🔔 Уведомления: <b>{notify_status}</b>\n\n"
             f"📤 <b>Отправьте файл</b> — сохранить\n"
@@ -662,9 +2992,9 @@ async def cmd_start(msg: types.Message, state: FSMContext):
 
 # ────────── Подписка ──────────
 @router.callback_query(F.data.startswith("checksub:"))
-async def check_sub_callback(call: types.CallbackQuery):
+async def check_sub_callback(call: types.CallbackQuery, user_ctx: UserContext):
     code = call.data.split(":", 1)[1]
-    if not await is_subscribed(call.from_user.id):
+    if not await is_subscribed(call.from_user.id, user_ctx.role):
         return await call.answer("❌ Вы ещё не подписались!", show_alert=True)
 
     await call.message.delete()
@@ -672,7 +3002,7 @@ async def check_sub_callback(call: types.CallbackQuery):
     if not entry:
         return await call.message.answer("❌ Файл не найден.")
 
-    await db_increment(code, entry.get("downloads") or 0)
+    db_increment(code)
     send_method = getattr(call.message, f"answer_{entry['type']}", None)
     if not send_method:
         return await call.message.answer("❌ Неподдерживаемый тип.")
@@ -711,6 +3041,14 @@ async def on_my_chat_member(update: types.ChatMemberUpdated):
         await remove_channel(chat.id)
 
 
+# Бот — админ CHANNEL_ID и получает chat_member о вступлениях/выходах
+@router.chat_member()
+async def on_chat_member(update: types.ChatMemberUpdated):
+    if not CHANNEL_ID or not is_sub_channel(update.chat):
+        return
+    set_membership(update.new_chat_member.user.id, update.new_chat_member.status)
+
+
 # ══════════════════════════════════════════════
 #  СОЗДАНИЕ ПОСТОВ — /post
 # ══════════════════════════════════════════════
@@ -719,8 +3057,8 @@ def post_cancel_hint() -> str:
 
 
 @router.message(Command("post"))
-async def cmd_post(msg: types.Message, state: FSMContext):
-    role = await get_role(msg.from_user.id)
+async def cmd_post(msg: types.Message, state: FSMContext, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await msg.answer("⛔ Только админы могут создавать посты.")
     await state.clear()
@@ -855,7 +3193,7 @@ async def post_download_name(msg: types.Message, state: FSMContext):
 
 # ── Шаг 5.6: Файл или ссылка ──
 @router.message(PostState.waiting_download_file)
-async def post_download_file(msg: types.Message, state: FSMContext):
+async def post_download_file(msg: types.Message, state: FSMContext, user_ctx: UserContext):
     if msg.text and msg.text.startswith("/"):
         return
 
@@ -869,7 +3207,7 @@ async def post_download_file(msg: types.Message, state: FSMContext):
 
     fid, ftype, fname = extract_file_info(msg)
     if fid:
-        role = await get_role(msg.from_user.id)
+        role = user_ctx.role
         code, link = await save_file_to_db(msg, role)
         if code and link:
             url = link
@@ -960,8 +3298,8 @@ async def post_media(msg: types.Message, state: FSMContext):
 
 # ── Шаг 8:   ыбор канала (кнопкой) ──
 @router.callback_query(PostState.waiting_channel, F.data.startswith("postch:"))
-async def post_channel_select(call: types.CallbackQuery, state: FSMContext):
-    role = await get_role(call.from_user.id)
+async def post_channel_select(call: types.CallbackQuery, state: FSMContext, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await call.answer("⛔ Недостаточно прав.", show_alert=True)
 
@@ -1138,8 +3476,8 @@ async def post_test_handler(call: types.CallbackQuery, state: FSMContext):
 #  УПРАВЛЕНИЕ АДМИНАМИ
 # ══════════════════════════════════════════════
 @router.message(Command("setadmin"))
-async def cmd_setadmin(msg: types.Message):
-    caller_role = await get_role(msg.from_user.id)
+async def cmd_setadmin(msg: types.Message, user_ctx: UserContext):
+    caller_role = user_ctx.role
     if caller_role < 3:
         return await msg.answer("⛔ Недостаточно прав.")
 
@@ -1204,8 +3542,8 @@ async def cmd_setadmin(msg: types.Message):
 
 
 @router.message(Command("removeadmin"))
-async def cmd_removeadmin(msg: types.Message):
-    caller_role = await get_role(msg.from_user.id)
+async def cmd_removeadmin(msg: types.Message, user_ctx: UserContext):
+    caller_role = user_ctx.role
     if caller_role < 3:
         return await msg.answer("⛔ Недостаточно прав.")
 
@@ -1257,8 +3595,8 @@ async def cmd_removeadmin(msg: types.Message):
 
 
 @router.message(Command("demote"))
-async def cmd_demote(msg: types.Message):
-    caller_role = await get_role(msg.from_user.id)
+async def cmd_demote(msg: types.Message, user_ctx: UserContext):
+    caller_role = user_ctx.role
     if caller_role < 3:
         return await msg.answer("⛔ Недостаточно прав.")
 
@@ -1314,8 +3652,8 @@ async def cmd_demote(msg: types.Message):
 
 
 @router.message(Command("resign"))
-async def cmd_resign(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_resign(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await msg.answer("❌ Вы не админ.")
     if msg.from_user.id == OWNER_ID:
@@ -1333,8 +3671,8 @@ async def cmd_resign(msg: types.Message):
 
 
 @router.message(Command("admins"))
-async def cmd_admins(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_admins(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 2:
         return await msg.answer("⛔ Недостаточно прав.")
     admins = await get_all_admins()
@@ -1350,27 +3688,19 @@ async def cmd_admins(msg: types.Message):
 
 
 @router.message(Command("adminstats"))
-async def cmd_adminstats(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_adminstats(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 3:
         return await msg.answer("⛔ Недостаточно прав.")
-    rows = await db_all()
-    stats = {}
-    for e in rows:
-        uid = e.get("uploaded_by", 0)
-        name = e.get("uploader_name", "?")
-        if uid not in stats:
-            stats[uid] = {"name": name, "files": 0, "downloads": 0}
-        stats[uid]["files"] += 1
-        stats[uid]["downloads"] += e.get("downloads") or 0
+    stats = await get_uploader_stats()
     if not stats:
         return await msg.answer("📊 Нет данных.")
+    roles = await get_roles(s["uploaded_by"] for s in stats)
     lines = []
-    sorted_stats = sorted(stats.items(), key=lambda x: x[1]["files"], reverse=True)
-    for uid, s in sorted_stats:
-        r = await get_role(uid)
+    for s in stats:
+        r = roles.get(s["uploaded_by"], 0)
         lines.append(
-            f"👤 <b>{s['name']}</b> ({ROLES.get(r, '?')})\n"
+            f"👤 <b>{s.get('uploader_name') or '?'}</b> ({ROLES.get(r, '?')})\n"
             f"   📁 Файлов: {s['files']} | 📥 Скачиваний: {s['downloads']}"
         )
     text = f"📊 <b>Статистика по админам:</b>\n\n" + "\n\n".join(lines)
@@ -1456,8 +3786,8 @@ async def deny_demote(call: types.CallbackQuery):
 #  БАНЫ
 # ══════════════════════════════════════════════
 @router.message(Command("ban"))
-async def cmd_ban(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_ban(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 3:
         return await msg.answer("⛔ Недостаточно прав.")
     parts = msg.text.split(maxsplit=2)
@@ -1487,8 +3817,8 @@ async def cmd_ban(msg: types.Message):
 
 
 @router.message(Command("unban"))
-async def cmd_unban(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_unban(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 3:
         return await msg.answer("⛔ Недостаточно прав.")
     parts = msg.text.split()
@@ -1515,8 +3845,7 @@ async def cmd_unban(msg: types.Message):
 async def cmd_sub(msg: types.Message):
     if msg.from_user.id != OWNER_ID:
         return await msg.answer("⛔ Только владелец.")
-    global sub_required
-    sub_required = not sub_required
+    await set_setting("sub_required", not sub_required)
     if sub_required:
         await msg.answer(f"✅ <b>Подписка ВКЛЮЧЕНА</b>\n\nКанал: {CHANNEL_LINK}", parse_mode="HTML")
     else:
@@ -1527,12 +3856,299 @@ async def cmd_sub(msg: types.Message):
 async def cmd_notify(msg: types.Message):
     if msg.from_user.id != OWNER_ID:
         return await msg.answer("⛔ Только владелец.")
-    global notify_uploads
-    notify_uploads = not notify_uploads
+    await set_setting("notify_uploads", not notify_uploads)
     status = "✅ ВКЛ" if notify_uploads else "❌ ВЫКЛ"
     await msg.answer(f"🔔 <b>Уведомления:</b> {status}", parse_mode="HTML")
 
 
+# ══════════════════════════════════════════════
+#  РАССЫЛКА — движок
+# ══════════════════════════════════════════════
+# Общий для всех рассылок лимит отправки; RetryAfter останавливает всех отправителей
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate / 5)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._updated = self._paused_until
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+
+
+# Задание рассылки из broadcast_jobs. Получатели идут по возрастанию user_id;
+# cursor — наибольший user_id, до которого включительно все уже обработаны.
+class Broadcast:
+    def __init__(self, row: dict):
+        self.id = row["id"]
+        self.from_chat_id = row["from_chat_id"]
+        self.message_id = row["message_id"]
+        self.status_chat_id = row.get("status_chat_id")
+        self.status_message_id = row.get("status_message_id")
+        self.total = row.get("total") or 0
+        self.sent = row.get("sent") or 0
+        self.failed = row.get("failed") or 0
+        self.blocked = row.get("blocked") or 0
+        self.cursor = row.get("cursor") or 0
+        # running | paused | cancelled | done | shutdown (остановлен перезапуском)
+        self.state = "running"
+        self.retry_after = 0
+        self.started = time.monotonic()
+        self._done_at_start = self.done
+        self._window: OrderedDict[int, bool] = OrderedDict()
+        self._outcomes: list[dict] = []
+        self._inactive: list[int] = []
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    def speed(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return (self.done - self._done_at_start) / elapsed if elapsed > 0 else 0.0
+
+    def eta(self) -> str:
+        speed = self.speed()
+        if not speed:
+            return "—"
+        left = int(max(0, self.total - self.done) / speed)
+        return f"{left // 3600}ч {left % 3600 // 60}м {left % 60}с" if left >= 3600 else f"{left // 60}м {left % 60}с"
+
+    def progress_text(self) -> str:
+        return (
+            f"📢 Рассылка #{self.id}... {self.done}/{self.total}\n"
+            f"✅{self.sent} 🚫{self.blocked} ❌{self.failed}\n"
+            f"⚡ {self.speed():.1f} сообщ./с, осталось ~{self.eta()}"
+        )
+
+    def final_text(self) -> str:
+        title = {
+            "done": "✅ <b>Рассылка завершена!</b>",
+            "paused": f"⏸ <b>Рассылка #{self.id} на паузе</b>",
+            "cancelled": f"⛔ <b>Рассылка #{self.id} отменена</b>",
+        }.get(self.state, f"📢 Рассылка #{self.id}")
+        return (
+            f"{title}\n\n"
+            f"👥 Всего: <b>{self.total}</b>\n✅ Доставлено: <b>{self.sent}</b>\n"
+            f"🚫 Заблокировали: <b>{self.blocked}</b>\n❌ Ошибки: <b>{self.failed}</b>\n"
+            f"⚡ Скорость: <b>{self.speed():.1f}</b> сообщ./с"
+        )
+
+    def controls(self) -> InlineKeyboardMarkup | None:
+        if self.state == "running":
+            row = [
+                InlineKeyboardButton(text="⏸ Пауза", callback_data=f"bc:pause:{self.id}"),
+                InlineKeyboardButton(text="⛔ Отменить", callback_data=f"bc:cancel:{self.id}"),
+            ]
+        elif self.state == "paused":
+            row = [
+                InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bc:resume:{self.id}"),
+                InlineKeyboardButton(text="⛔ Отменить", callback_data=f"bc:cancel:{self.id}"),
+            ]
+        else:
+            return None
+        return InlineKeyboardMarkup(inline_keyboard=[row])
+
+    async def show(self, text: str, parse_mode: str = None):
+        if not self.status_chat_id:
+            return
+        try:
+            await bot.edit_message_text(
+                text, chat_id=self.status_chat_id, message_id=self.status_message_id,
+                parse_mode=parse_mode, reply_markup=self.controls(),
+            )
+        except Exception:
+            pass
+
+    async def send_one(self, user_id: int) -> str:
+        for attempt in range(BROADCAST_RETRIES):
+            await broadcast_bucket.acquire()
+            try:
+                await bot.copy_message(
+                    chat_id=user_id, from_chat_id=self.from_chat_id, message_id=self.message_id,
+                )
+                return "sent"
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                broadcast_bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except (TelegramNetworkError, TelegramServerError):
+                await asyncio.sleep(min(30, 2 ** attempt) * random.uniform(0.5, 1.5))
+            except Exception as e:
+                err = str(e).lower()
+                if "blocked" in err or "deactivated" in err:
+                    return "blocked"
+                return "failed"
+        return "failed"
+
+    def record(self, user_id: int, outcome: str):
+        if outcome == "sent":
+            self.sent += 1
+        elif outcome == "blocked":
+            self.blocked += 1
+            self._inactive.append(user_id)
+        else:
+            self.failed += 1
+        self._outcomes.append({"job_id": self.id, "user_id": user_id, "outcome": outcome})
+        self._window[user_id] = True
+        while self._window:
+            uid, finished = next(iter(self._window.items()))
+            if not finished:
+                break
+            self._window.popitem(last=False)
+            self.cursor = uid
+
+    async def checkpoint(self, final: bool = False):
+        # Сначала исходы получателей, потом курсор: после падения
+        # повторно уйдут только сообщения, чей исход не успел записаться
+        outcomes, self._outcomes = self._outcomes, []
+        if outcomes:
+            try:
+                await save_broadcast_outcomes(outcomes)
+            except Exception as e:
+                logging.error(f"Broadcast outcomes save: {e}")
+                self._outcomes = outcomes + self._outcomes
+                return
+        inactive, self._inactive = self._inactive, []
+        if inactive:
+            try:
+                await mark_users_inactive(inactive)
+            except Exception as e:
+                logging.error(f"Mark users inactive: {e}")
+                self._inactive = inactive + self._inactive
+        await update_broadcast_job(self.id, {
+            "cursor": self.cursor,
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "status": "running" if self.state == "shutdown" else self.state,
+            # Последний чекпоинт отпускает задание: после перезапуска его
+            # можно подобрать сразу, не дожидаясь конца аренды
+            "owner": None if final else broadcast_owner,
+            "lease_until": None if final else time.time() + BROADCAST_LEASE_SEC,
+        })
+
+    async def run(self, pages, skip: set[int] = frozenset()):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 2)
+
+        async def worker():
+            while True:
+                uid = await queue.get()
+                if uid is None:
+                    return
+                self.record(uid, await self.send_one(uid))
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(BROADCAST_CHECKPOINT_SEC)
+                await self.checkpoint()
+                await self.show(self.progress_text())
+
+        workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+        progress = asyncio.create_task(reporter())
+        try:
+            async with aclosing(pages):
+                async for page in pages:
+                    for uid in page:
+                        if self.state != "running":
+                            break
+                        if uid in skip:
+                            continue
+                        self._window[uid] = False
+                        await queue.put(uid)
+                    if self.state != "running":
+                        break
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            progress.cancel()
+        if self.state == "running":
+            self.state = "done"
+        await self.checkpoint(final=True)
+
+
+broadcast_jobs: dict[int, Broadcast] = {}
+broadcast_tasks: dict[int, asyncio.Task] = {}
+# Владелец в broadcast_jobs.owner — у каждого воркера свой
+broadcast_owner = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def broadcast_lease() -> dict:
+    return {"owner": broadcast_owner, "lease_until": time.time() + BROADCAST_LEASE_SEC}
+
+
+async def run_broadcast_job(job: Broadcast):
+    try:
+        skip = await get_broadcast_done_after(job.id, job.cursor)
+        await job.run(iter_user_id_pages(job.cursor), skip)
+        if job.state != "shutdown":
+            await job.show(job.final_text(), parse_mode="HTML")
+    except Exception as e:
+        logging.error(f"Broadcast #{job.id} error: {e}")
+    finally:
+        broadcast_jobs.pop(job.id, None)
+        broadcast_tasks.pop(job.id, None)
+
+
+def start_broadcast_job(job: Broadcast):
+    broadcast_jobs[job.id] = job
+    broadcast_tasks[job.id] = asyncio.create_task(run_broadcast_job(job))
+
+
+# Задания в статусе running без живого владельца: процесс упал или
+# остановился. Забираем условным UPDATE — второй воркер не запустит то же задание
+async def resume_broadcast_jobs():
+    for row in await get_running_broadcast_jobs():
+        if row["id"] in broadcast_jobs:
+            continue
+        row = await claim_broadcast_job(row["id"], "running", broadcast_lease())
+        if row and row["id"] not in broadcast_jobs:
+            logging.info(f"Resuming broadcast #{row['id']} from user_id {row.get('cursor')}")
+            start_broadcast_job(Broadcast(row))
+
+
+async def broadcast_resume_loop():
+    while True:
+        await asyncio.sleep(BROADCAST_LEASE_SEC)
+        try:
+            await resume_broadcast_jobs()
+        except Exception as e:
+            logging.error(f"Broadcast resume: {e}")
+
+
+async def stop_broadcast_jobs(timeout: float = 10):
+    for job in broadcast_jobs.values():
+        job.state = "shutdown"
+    tasks = list(broadcast_tasks.values())
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+
+
 # ══════════════════════════════════════════════
 #  РАССЫЛКА
 # ══════════════════════════════════════════════
@@ -1540,7 +4156,7 @@ async def cmd_notify(msg: types.Message):
 async def cmd_send(msg: types.Message, state: FSMContext):
     if msg.from_user.id != OWNER_ID:
         return await msg.answer("⛔ Только владелец.")
-    users = await count_users()
+    users = await count_users(active_only=True)
     await state.set_state(BroadcastState.waiting_message)
     await msg.answer(
         f"📢 <b>Рассылка</b>\n\n👥 Получателей: <b>{users}</b>\n\nОтправьте сообщение.\n/cancel — отмена",
@@ -1549,8 +4165,8 @@ async def cmd_send(msg: types.Message, state: FSMContext):
 
 
 @router.message(Command("cancel"))
-async def cmd_cancel(msg: types.Message, state: FSMContext):
-    role = await get_role(msg.from_user.id)
+async def cmd_cancel(msg: types.Message, state: FSMContext, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return
     current = await state.get_state()
@@ -1566,44 +4182,78 @@ async def do_broadcast(msg: types.Message, state: FSMContext):
     if msg.from_user.id != OWNER_ID:
         return
     await state.clear()
-    user_ids = await get_all_users()
-    total = len(user_ids)
+    total = await count_users(active_only=True)
     if total == 0:
         return await msg.answer("👥 Нет пользователей.")
     status = await msg.answer(f"📢 Рассылка... 0/{total}")
-    sent = failed = blocked = 0
-    for uid in user_ids:
-        try:
-            await msg.copy_to(chat_id=uid)
-            sent += 1
-        except Exception as e:
-            err = str(e).lower()
-            if "blocked" in err or "deactivated" in err:
-                blocked += 1
-            else:
-                failed += 1
-        done = sent + failed + blocked
-        if done % 25 == 0:
-            await asyncio.sleep(1)
-        if done % 50 == 0:
-            try:
-                await status.edit_text(f"📢 Рассылка... {done}/{total}\n✅{sent} 🚫{blocked} ❌{failed}")
-            except Exception:
-                pass
-    await status.edit_text(
-        f"✅ <b>Рассылка завершена!</b>\n\n"
-        f"👥 Всего: <b>{total}</b>\n✅ Доставлено: <b>{sent}</b>\n"
-        f"🚫 Заблокировали: <b>{blocked}</b>\n❌ Ошибки: <b>{failed}</b>",
-        parse_mode="HTML",
-    )
+    try:
+        row = await create_broadcast_job({
+            "from_chat_id": msg.chat.id,
+            "message_id": msg.message_id,
+            "status_chat_id": status.chat.id,
+            "status_message_id": status.message_id,
+            "total": total,
+            "status": "running",
+            **broadcast_lease(),
+        })
+    except Exception as e:
+        logging.error(f"Broadcast job create: {e}")
+        return await status.edit_text("❌ Не удалось создать рассылку.")
+    job = Broadcast(row)
+    start_broadcast_job(job)
+    await job.show(job.progress_text())
+
+
+@router.callback_query(F.data.startswith("bc:"))
+async def broadcast_control(call: types.CallbackQuery):
+    if call.from_user.id != OWNER_ID:
+        return await call.answer("⛔ Только владелец.", show_alert=True)
+    try:
+        _, action, job_id = call.data.split(":")
+        job_id = int(job_id)
+    except ValueError:
+        return await call.answer()
+
+    job = broadcast_jobs.get(job_id)
+    if job:
+        if action == "pause":
+            job.state = "paused"
+            return await call.answer("⏸ Ставлю на паузу...")
+        if action == "cancel":
+            job.state = "cancelled"
+            return await call.answer("⛔ Отменяю...")
+        return await call.answer("Рассылка уже идёт.")
+
+    row = await get_broadcast_job(job_id)
+    if bus.active and row and row.get("status") == "running" and action in ("pause", "cancel"):
+        # Задание идёт в другом воркере
+        bus.publish("broadcast", job_id=job_id, action="paused" if action == "pause" else "cancelled")
+        return await call.answer("⏸ Ставлю на паузу..." if action == "pause" else "⛔ Отменяю...")
+    if not row or row.get("status") != "paused" or action not in ("resume", "cancel"):
+        return await call.answer("Рассылка уже завершена.", show_alert=True)
+
+    # Повторное нажатие или другой воркер могли забрать задание раньше —
+    # запускает только тот, чей условный UPDATE изменил строку
+    fields = {"status": "running", **broadcast_lease()} if action == "resume" else {"status": "cancelled"}
+    row = await claim_broadcast_job(job_id, "paused", fields)
+    if not row or job_id in broadcast_jobs:
+        return await call.answer("Рассылка уже идёт." if action == "resume" else "Рассылка уже завершена.")
+    job = Broadcast(row)
+    if action == "resume":
+        start_broadcast_job(job)
+        await job.show(job.progress_text())
+        return await call.answer("▶️ Продолжаю.")
+    job.state = "cancelled"
+    await job.show(job.final_text(), parse_mode="HTML")
+    await call.answer("⛔ Отменено.")
 
 
 # ════════════════   ═════════════════════════════
 #  ФАЙЛЫ — приём
 # ══════════════════════════════════════════════
 @router.message(F.content_type.in_(MEDIA_TYPES))
-async def save_file_handler(msg: types.Message, state: FSMContext):
-    role = await get_role(msg.from_user.id)
+async def save_file_handler(msg: types.Message, state: FSMContext, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await msg.answer("⛔ Только админы могут добавлять файлы.")
 
@@ -1644,36 +4294,29 @@ async def save_file_handler(msg: types.Message, state: FSMContext):
 #  ФАЙЛЫ — команды
 # ══════════════════════════════════════════════
 @router.message(Command("find"))
-async def cmd_find(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_find(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await msg.answer("⛔ Недостаточно прав.")
     parts = msg.text.split(maxsplit=1)
     if len(parts) < 2:
         return await msg.answer("📝 <b>Формат:</b> /find <code>название</code>", parse_mode="HTML")
     query = parts[1].strip().lower()
-    rows = await db_all()
-    found = [e for e in rows if query in (e.get("name") or "").lower() or query in (e.get("caption") or "").lower()]
+    found, total = await search_files(query)
     if not found:
         return await msg.answer(f"🔍 Ничего не найдено по «{query}»")
-    lines = []
-    for e in found:
-        link = f"https://t.me/{BOT_USER}?start={e['code']}"
-        uploader = e.get("uploader_name", "?")
-        up_role = e.get("uploader_role") or 0
-        downloads = e.get("downloads") or 0
-        lines.append(
-            f"📁 <b>{e.get('name', '?')}</b> 📥{downloads}\n"
-            f"   👤 {uploader} ({ROLES.get(up_role, '?')})\n   <code>{e['code']}</code>\n   {link}"
-        )
-    text = f"🔍 <b>Найдено ({len(found)}):</b>\n\n" + "\n\n".join(lines)
+    lines = [file_list_line(e, with_uploader=True) for e in found]
+    header = f"🔍 <b>Найдено ({total}):</b>"
+    if total > len(found):
+        header += f" показаны первые {len(found)}"
+    text = header + "\n\n" + "\n\n".join(lines)
     for i in range(0, len(text), 4000):
         await msg.answer(text[i:i + 4000], parse_mode="HTML", disable_web_page_preview=True)
 
 
 @router.message(Command("info"))
-async def cmd_info(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_info(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await msg.answer("⛔ Недостаточно прав.")
     parts = msg.text.split(maxsplit=1)
@@ -1684,7 +4327,7 @@ async def cmd_info(msg: types.Message):
     if not entry:
         return await msg.answer("❌ Не найдено.")
     up_role = entry.get("uploader_role") or 0
-    downloads = entry.get("downloads") or 0
+    downloads = downloads_of(entry)
     created = (entry.get("created_at") or "?")[:10]
     link = f"https://t.me/{BOT_USER}?start={code}"
     await msg.answer(
@@ -1698,8 +4341,8 @@ async def cmd_info(msg: types.Message):
 
 
 @router.message(Command("rename"))
-async def cmd_rename(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_rename(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await msg.answer("⛔ Недостаточно прав.")
     parts = msg.text.split(maxsplit=2)
@@ -1716,51 +4359,92 @@ async def cmd_rename(msg: types.Message):
     await msg.answer(f"✅ <b>Переименовано:</b>\n📁 {entry.get('name', '?')} → <b>{new_name}</b>", parse_mode="HTML")
 
 
+def file_list_line(e: dict, with_uploader: bool) -> str:
+    link = f"https://t.me/{BOT_USER}?start={e['code']}"
+    downloads = downloads_of(e)
+    line = f"📁 <b>{e.get('name', '?')}</b> 📥{downloads}\n"
+    if with_uploader:
+        uploader = e.get("uploader_name", "?")
+        up_role = e.get("uploader_role") or 0
+        line += f"   👤 {uploader} ({ROLES.get(up_role, '?')})\n"
+    return line + f"   <code>{e['code']}</code>\n   {link}"
+
+
+# scope: "a" — все файлы (/list), "m" — файлы пользователя (/myfiles)
+async def render_files_page(scope: str, user_id: int, page: int,
+                            cursor: tuple = None, backward: bool = False):
+    uploaded_by = user_id if scope == "m" else None
+    rows, has_more = await db_page(uploaded_by, cursor, backward)
+    if not rows:
+        return None, None
+    has_next = has_more or backward
+    title = "Ваши файлы" if scope == "m" else "Все файлы"
+    lines = [file_list_line(e, with_uploader=scope == "a") for e in rows]
+    text = f"📂 <b>{title}</b> — стр. {page}\n\n" + "\n\n".join(lines)
+
+    nav = []
+    if page > 1:
+        first = rows[0]
+        nav.append(InlineKeyboardButton(
+            text="◀️", callback_data=f"fp:{scope}:p:{page - 1}:{first['code']}:{first['created_at']}"))
+    if has_next:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton(
+            text="▶️", callback_data=f"fp:{scope}:n:{page + 1}:{last['code']}:{last['created_at']}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return text, kb
+
+
 @router.message(Command("myfiles"))
-async def cmd_myfiles(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_myfiles(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await msg.answer("⛔ Недостаточно прав.")
-    rows = await db_all()
-    my = [e for e in rows if e.get("uploaded_by") == msg.from_user.id]
-    if not my:
+    text, kb = await render_files_page("m", msg.from_user.id, 1)
+    if not text:
         return await msg.answer("📂 У вас нет файлов.")
-    lines = []
-    for e in my:
-        link = f"https://t.me/{BOT_USER}?start={e['code']}"
-        downloads = e.get("downloads") or 0
-        lines.append(f"📁 <b>{e.get('name', '?')}</b> 📥{downloads}\n   <code>{e['code']}</code>\n   {link}")
-    text = f"📂 <b>Ваши файлы ({len(my)}):</b>\n\n" + "\n\n".join(lines)
-    for i in range(0, len(text), 4000):
-        await msg.answer(text[i:i + 4000], parse_mode="HTML", disable_web_page_preview=True)
+    await msg.answer(text, parse_mode="HTML", reply_markup=kb, disable_web_page_preview=True)
 
 
 @router.message(Command("list"))
-async def cmd_list(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_list(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await msg.answer("⛔ Недостаточно прав.")
-    rows = await db_all()
-    if not rows:
+    text, kb = await render_files_page("a", msg.from_user.id, 1)
+    if not text:
         return await msg.answer("📂 Пусто.")
-    lines = []
-    for e in rows:
-        link = f"https://t.me/{BOT_USER}?start={e['code']}"
-        uploader = e.get("uploader_name", "?")
-        up_role = e.get("uploader_role") or 0
-        downloads = e.get("downloads") or 0
-        lines.append(
-            f"📁 <b>{e.get('name', '?')}</b> 📥{downloads}\n"
-            f"   👤 {uploader} ({ROLES.get(up_role, '?')})\n   <code>{e['code']}</code>\n   {link}"
+    await msg.answer(text, parse_mode="HTML", reply_markup=kb, disable_web_page_preview=True)
+
+
+@router.callback_query(F.data.startswith("fp:"))
+async def files_page_callback(call: types.CallbackQuery, user_ctx: UserContext):
+    role = user_ctx.role
+    if role < 1:
+        return await call.answer("⛔ Недостаточно прав.", show_alert=True)
+    try:
+        _, scope, direction, page, code, created_at = call.data.split(":", 5)
+        page = int(page)
+    except ValueError:
+        return await call.answer()
+    text, kb = await render_files_page(
+        scope, call.from_user.id, page,
+        cursor=(created_at, code), backward=direction == "p",
+    )
+    if not text:
+        return await call.answer("📂 Больше файлов нет.")
+    try:
+        await call.message.edit_text(
+            text, parse_mode="HTML", reply_markup=kb, disable_web_page_preview=True,
         )
-    text = f"📂 <b>Все файлы ({len(rows)}):</b>\n\n" + "\n\n".join(lines)
-    for i in range(0, len(text), 4000):
-        await msg.answer(text[i:i + 4000], parse_mode="HTML", disable_web_page_preview=True)
+    except Exception:
+        pass
+    await call.answer()
 
 
 @router.message(Command("del"))
-async def cmd_del(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_del(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await msg.answer("⛔ Недостаточно прав.")
     parts = msg.text.split(maxsplit=1)
@@ -1780,18 +4464,14 @@ async def cmd_del(msg: types.Message):
 
 
 @router.message(Command("stats"))
-async def cmd_stats(msg: types.Message):
-    role = await get_role(msg.from_user.id)
+async def cmd_stats(msg: types.Message, user_ctx: UserContext):
+    role = user_ctx.role
     if role < 1:
         return await msg.answer("⛔ Недостаточно прав.")
-    rows = await db_all()
-    users = await count_users()
-    total = len(rows)
-    dl = sum(e.get("downloads") or 0 for e in rows)
-    top = sorted(rows, key=lambda x: x.get("downloads") or 0, reverse=True)[:5]
+    stats = await get_stats()
     top_lines = []
-    for i, e in enumerate(top, 1):
-        downloads = e.get("downloads") or 0
+    for i, e in enumerate(stats["top"], 1):
+        downloads = downloads_of(e)
         name = e.get("name", "?")
         uploader = e.get("uploader_name", "?")
         up_role = e.get("uploader_role") or 0
@@ -1800,11 +4480,10 @@ async def cmd_stats(msg: types.Message):
         )
     sub_status = "✅ ВКЛ" if sub_required else "❌ ВЫКЛ"
     notify_status = "✅ ВКЛ" if notify_uploads else "❌ ВЫКЛ"
-    admins = await get_all_admins()
     text = (
         f"📊 <b>Статистика</b>\n\n"
-        f"📁 Файлов: <b>{total}</b>\n👥 Пользователей: <b>{users}</b>\n"
-        f"📥 Всего скачиваний: <b>{dl}</b>\n👮 Админов: <b>{len(admins)}</b>\n"
+        f"📁 Файлов: <b>{stats['files']}</b>\n👥 Пользователей: <b>{stats['users']}</b>\n"
+        f"📥 Всего скачиваний: <b>{stats['downloads']}</b>\n👮 Админов: <b>{stats['admins']}</b>\n"
         f"📢 Подписка: <b>{sub_status}</b>\n🔔 Уведомления: <b>{notify_status}</b>"
     )
     if top_lines:
@@ -1814,12 +4493,54 @@ async def cmd_stats(msg: types.Message):
     await msg.answer(text, parse_mode="HTML")
 
 
+@router.message(Command("cache"))
+async def cmd_cache(msg: types.Message):
+    if msg.from_user.id != OWNER_ID:
+        return await msg.answer("⛔ Только владелец.")
+    updates = cache_stats["updates"] or 1
+    ban_saved = cache_stats["ban_checks"] - cache_stats["ban_db_queries"]
+    bans_total = len(banned_ids) if banned_ids is not None else "—"
+    file_hits = cache_stats["file_mem_hits"] + cache_stats["file_disk_hits"] + cache_stats["file_negative_hits"]
+    file_total = file_hits + cache_stats["file_misses"]
+    file_ratio = file_hits * 100 / file_total if file_total else 0
+    await msg.answer(
+        f"🗄 <b>Кэш</b>\n\n"
+        f"📨 Апдейтов: <b>{cache_stats['updates']}</b>\n\n"
+        f"👮 Роли: <b>{len(role_cache)}</b> записей, "
+        f"хиты {role_cache.hits} / промахи {role_cache.misses}\n"
+        f"🚫 Баны: <b>{bans_total}</b> в памяти, проверок {cache_stats['ban_checks']}, "
+        f"запросов в БД {cache_stats['ban_db_queries']}\n"
+        f"   Сэкономлено запросов на 1k апдейтов: <b>{ban_saved * 1000 / updates:.0f}</b>\n"
+        f"📁 Файлы: <b>{len(file_cache)}</b> в памяти, хиты: память {cache_stats['file_mem_hits']}, "
+        f"диск {cache_stats['file_disk_hits']}, «нет файла» {cache_stats['file_negative_hits']}; "
+        f"промахи {cache_stats['file_misses']} (<b>{file_ratio:.1f}%</b> попаданий)\n"
+        f"📢 Подписки: <b>{len(member_cache)}</b> записей, "
+        f"хиты {member_cache.hits} / промахи {member_cache.misses}",
+        parse_mode="HTML",
+    )
+
+
+# ── База недоступна ──
+@router.errors(ExceptionTypeFilter(StorageError))
+async def on_db_error(event: types.ErrorEvent):
+    logging.error(f"DB error: {event.exception}")
+    text = "⚠️ База данных временно недоступна, попробуйте позже."
+    update = event.update
+    try:
+        if update.message:
+            await update.message.answer(text)
+        elif update.callback_query:
+            await update.callback_query.answer(text, show_alert=True)
+    except Exception:
+        pass
+
+
 # ── Fallback ──
 @router.message()
-async def fallback(msg: types.Message, state: FSMContext):
-    if await is_banned(msg.from_user.id):
+async def fallback(msg: types.Message, state: FSMContext, user_ctx: UserContext):
+    if user_ctx.banned:
         return await msg.answer("🚫 Вы заблокированы.")
-    role = await get_role(msg.from_user.id)
+    role = user_ctx.role
     if role >= 1:
         await msg.answer(
             "📤 Отправьте файл для сохранения.\nНажмите <b>/</b> для списка команд.",
@@ -1829,19 +4550,260 @@ async def fallback(msg: types.Message, state: FSMContext):
         await msg.answer("Перейдите по ссылке от отправителя.")
 
 
+@dp.update.outer_middleware()
+async def count_updates(handler, event, data):
+    cache_stats["updates"] += 1
+    updates_total.inc((event.event_type,))
+    updates_in_flight.inc()
+    try:
+        return await handler(event, data)
+    finally:
+        updates_in_flight.inc(value=-1)
+
+
+async def observe_handler(handler, event, data):
+    name = data["handler"].callback.__name__
+    trace = current_trace.get()
+    if trace:
+        trace.handler = name
+    t = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        handler_errors.inc((name,))
+        raise
+    finally:
+        handler_seconds.observe(time.perf_counter() - t, (name,))
+
+
+@dp.update.outer_middleware()
+async def trace_updates(handler, event, data):
+    user_id = event_user_id(event)
+    trace = UpdateTrace(event.update_id, event.event_type, user_id)
+    token = current_trace.set(trace)
+    try:
+        return await handler(event, data)
+    finally:
+        current_trace.reset(token)
+        trace.closed = True
+        duration = time.perf_counter() - trace.started
+        if TRACE_WATERFALL == "all" or user_id in waterfall_users:
+            logging.info(trace.waterfall(duration))
+        if trace.call_count > TRACE_CALL_BUDGET or duration * 1000 > TRACE_SLOW_MS:
+            logging.warning(f"Update over budget: {json.dumps(trace.to_dict(duration), ensure_ascii=False)}")
+
+
+# Только сообщения и кнопки: апдейты участников канала user_ctx не используют,
+# и на всплеске вступлений каждый новый пользователь стоил бы запроса в базу
+async def user_context(handler, event, data):
+    user = data.get("event_from_user")
+    if user:
+        data["user_ctx"] = await resolve_user_context(user.id)
+    return await handler(event, data)
+
+
+for observer in (router.message, router.callback_query):
+    observer.outer_middleware(user_context)
+for observer in (router.message, router.callback_query, router.my_chat_member, router.chat_member):
+    observer.middleware(observe_handler)
+
+
+# ── Метрики, которые снимаются в момент скрейпа ──
+def collect_cache_hits() -> dict:
+    return {
+        ("role",): role_cache.hits,
+        ("member",): member_cache.hits,
+        ("file",): cache_stats["file_mem_hits"] + cache_stats["file_disk_hits"] + cache_stats["file_negative_hits"],
+        ("ban",): cache_stats["ban_checks"] - cache_stats["ban_db_queries"],
+        ("fsm",): fsm_storage.cache.hits if isinstance(fsm_storage, DbFSMStorage) else 0,
+    }
+
+
+def collect_cache_misses() -> dict:
+    return {
+        ("role",): role_cache.misses,
+        ("member",): member_cache.misses,
+        ("file",): cache_stats["file_misses"],
+        ("ban",): cache_stats["ban_db_queries"],
+        ("fsm",): fsm_storage.cache.misses if isinstance(fsm_storage, DbFSMStorage) else 0,
+    }
+
+
+def collect_cache_ratio() -> dict:
+    hits, misses = collect_cache_hits(), collect_cache_misses()
+    return {k: round(hits[k] / (hits[k] + misses[k]), 4) for k in hits if hits[k] + misses[k]}
+
+
+def collect_tasks() -> dict:
+    return {
+        ("asyncio",): len(asyncio.all_tasks()),
+        ("background",): sum(1 for task in background_tasks if not task.done()),
+        ("broadcast",): len(broadcast_tasks),
+    }
+
+
+CounterMetric("filesbot_cache_hits_total", "Cache hits", ("cache",), collect=collect_cache_hits)
+CounterMetric("filesbot_cache_misses_total", "Cache misses", ("cache",), collect=collect_cache_misses)
+GaugeMetric("filesbot_cache_hit_ratio", "Cache hit ratio since start", ("cache",), collect=collect_cache_ratio)
+GaugeMetric("filesbot_cache_entries", "Entries held in memory", ("cache",), collect=lambda: {
+    ("role",): len(role_cache), ("member",): len(member_cache), ("file",): len(file_cache),
+    ("ban",): len(banned_ids) if banned_ids is not None else 0, ("search",): len(search_index),
+})
+GaugeMetric("filesbot_tasks", "Running asyncio tasks", ("kind",), collect=collect_tasks)
+GaugeMetric("filesbot_pending_writes", "Buffered writes not yet flushed", ("buffer",), collect=lambda: {
+    ("downloads",): len(pending_downloads), ("users",): len(pending_users),
+    ("fsm",): len(fsm_storage.dirty) if isinstance(fsm_storage, DbFSMStorage) else 0,
+})
+CounterMetric("filesbot_bus_messages_total", "Invalidation bus events", ("direction",), collect=lambda: {
+    ("published",): bus.published, ("received",): bus.received, ("send_error",): bus.send_errors,
+})
+CounterMetric("filesbot_bus_resyncs_total", "Cache resyncs after a missed bus event",
+              collect=lambda: {(): bus.resyncs})
+GaugeMetric("filesbot_supabase_circuit_open", "1 while the Supabase circuit breaker is open",
+            collect=lambda: {(): int(http.circuit_open)})
+
+
 dp.include_router(router)
 
 
+# ══════════════════════════════════════════════
+#  ОЧЕРЕДЬ АПДЕЙТОВ
+# ══════════════════════════════════════════════
+update_wait_seconds = HistogramMetric(
+    "filesbot_update_queue_wait_seconds", "Time an update waited in the queue before a worker took it",
+)
+updates_rejected = CounterMetric("filesbot_update_queue_rejected_total", "Webhooks answered 503, queue full")
+
+
+def update_chat_key(update: dict) -> int:
+    for field, obj in update.items():
+        if field == "update_id" or not isinstance(obj, dict):
+            continue
+        chat = obj.get("chat") or (obj.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if obj.get("from"):
+            return obj["from"]["id"]
+    return update.get("update_id", 0)
+
+
+# Вебхук сразу отвечает 200, апдейт уходит в очередь своего чата.
+# ready — чаты, у которых есть необработанные апдейты и никто их сейчас
+# не обрабатывает; воркер берёт чат, обрабатывает один апдейт и, если
+# в чате есть ещё, ставит его в конец ready — чаты не голодают друг из-за друга,
+# а шаги одного /post никогда не идут параллельно.
+# Очередь своя у каждого процесса: при WORKERS > 1 апдейты одного чата,
+# попавшие в разные воркеры, друг друга не ждут.
+class OrderedRequestHandler(SimpleRequestHandler):
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int, max_queued: int):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True)
+        self.workers = workers
+        self.max_queued = max_queued
+        self.lanes: dict[int, deque] = {}
+        self.ready: asyncio.Queue | None = None
+        self.tasks: list[asyncio.Task] = []
+        self.queued = 0
+        self.busy = 0
+
+    def register(self, app: web.Application, /, path: str, **kwargs):
+        app.on_startup.append(self._start)
+        super().register(app, path=path, **kwargs)
+
+    async def _start(self, _app):
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if self.queued >= self.max_queued:
+            updates_rejected.inc()
+            return web.Response(status=503)
+        update = await request.json(loads=bot.session.json_loads)
+        key = update_chat_key(update)
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = deque()
+            self.ready.put_nowait(key)
+        lane.append((time.perf_counter(), bot, update))
+        self.queued += 1
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _worker(self):
+        while True:
+            key = await self.ready.get()
+            lane = self.lanes[key]
+            queued_at, bot_, update = lane.popleft()
+            self.queued -= 1
+            self.busy += 1
+            update_wait_seconds.observe(time.perf_counter() - queued_at)
+            try:
+                await self._background_feed_update(bot_, update)
+            except Exception as e:
+                logging.exception(f"Update {update.get('update_id')}: {e}")
+            finally:
+                self.busy -= 1
+                if lane:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.lanes[key]
+
+    async def close(self):
+        # Дорабатываем очередь, пока живы сессия бота и хранилище
+        deadline = time.monotonic() + UPDATE_DRAIN_SEC
+        while (self.queued or self.busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.queued or self.busy:
+            logging.warning(f"Shutdown: dropping {self.queued} queued updates")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await super().close()
+
+
+webhook_handler = OrderedRequestHandler(dp, bot, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+GaugeMetric("filesbot_update_queue", "Webhook update queue", ("kind",), collect=lambda: {
+    ("queued",): webhook_handler.queued, ("chats",): len(webhook_handler.lanes),
+    ("busy_workers",): webhook_handler.busy, ("workers",): webhook_handler.workers,
+})
+
+
 # ══════════════════════════════════════════════
 #  ЗАПУСК
 # ══════════════════════════════════════════════
+# Номер процесса при WORKERS > 1; воркер 0 — ведущий
+worker_id = 0
+
+
+def is_leader() -> bool:
+    return worker_id == 0
+
+
 async def on_startup(**kwargs):
-    global http
-    http = ClientSession(headers={
-        "apikey": SUPA_KEY,
-        "Authorization": f"Bearer {SUPA_KEY}",
-        "Content-Type": "application/json",
-    })
+    open_file_disk_cache()
+    await storage.start()
+    if WORKERS > 1:
+        # До загрузки кэшей: всё, что запишут после, придёт по шине
+        await bus.start(worker_id)
+        background_tasks.append(asyncio.create_task(bus_heartbeat_loop()))
+    await load_roles()
+    await load_bans()
+    await load_settings()
+    if is_leader():
+        try:
+            await resume_broadcast_jobs()
+        except StorageError as e:
+            logging.error(f"Broadcast resume: {e}")
+        background_tasks.append(asyncio.create_task(broadcast_resume_loop()))
+    background_tasks.append(asyncio.create_task(bans_refresh_loop()))
+    background_tasks.append(asyncio.create_task(downloads_flush_loop()))
+    background_tasks.append(asyncio.create_task(users_flush_loop()))
+    if isinstance(fsm_storage, DbFSMStorage):
+        background_tasks.append(asyncio.create_task(fsm_flush_loop()))
+    if SEARCH_BACKEND == "index":
+        background_tasks.append(asyncio.create_task(load_search_index_safe()))
+    if not is_leader():
+        logging.info(f"Worker {worker_id} started, storage: {storage.name}")
+        return
     await bot.set_webhook(
         f"{BASE_URL}{WH_PATH}",
         allowed_updates=dp.resolve_used_update_types(),
@@ -1851,36 +4813,128 @@ async def on_startup(**kwargs):
         await save_channel(QWITUX_CHANNEL_ID, QWITUX_CHANNEL_TITLE)
     except Exception:
         pass
-    logging.info("Webhook set, commands set, Supabase connected")
+    logging.info(f"Webhook set, commands set, storage: {storage.name}")
 
 
 async def on_shutdown(**kwargs):
-    global http
-    if http:
-        await http.close()
-        http = None
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await stop_broadcast_jobs()
+    await flush_downloads()
+    await flush_users()
+    bus.close()
+    if file_disk_cache:
+        file_disk_cache.close()
+    await storage.close()
 
 
 async def health(_r):
     return web.Response(text="OK")
 
 
-def main():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
+async def metrics(request: web.Request):
+    if METRICS_TOKEN:
+        token = request.query.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+            return web.Response(status=401)
+    return web.Response(
+        body=render_metrics().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
     )
+
+
+def make_app() -> web.Application:
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
 
     app = web.Application()
     app.router.add_get("/", health)
     app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
 
-    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=WH_PATH)
+    webhook_handler.register(app, path=WH_PATH)
     setup_application(app, dp, bot=bot)
+    if METRICS_PORT:
+        app.cleanup_ctx.append(metrics_site)
+    return app
+
+
+# /metrics этого воркера на METRICS_PORT + worker_id
+async def metrics_site(_app):
+    metrics_app = web.Application()
+    metrics_app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(metrics_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", METRICS_PORT + worker_id).start()
+    yield
+    await runner.cleanup()
+
+
+def setup_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(processName)s %(message)s" if WORKERS > 1
+        else "%(asctime)s [%(levelname)s] %(message)s",
+    )
+
 
-    web.run_app(app, host="0.0.0.0", port=PORT)
+# Один воркер: свой Bot, Dispatcher, ClientSession и кэши — процесс
+# запускается через spawn и импортирует модуль заново
+def run_worker(index: int):
+    global worker_id, metrics_worker_label
+    worker_id = index
+    if WORKERS > 1:
+        # Сигналы с терминала получает только супервизор и рассылает их сам
+        os.setpgrp()
+        metrics_worker_label = f'worker="{index}"'
+    setup_logging()
+    web.run_app(make_app(), host="0.0.0.0", port=PORT, reuse_port=WORKERS > 1,
+                print=None if index else print)
+
+
+# Супервизор: держит WORKERS процессов на одном порту, перезапускает упавшие,
+# по SIGTERM/SIGINT останавливает всех (каждый дописывает свои буферы)
+def run_supervisor():
+    if FSM_BACKEND == "memory":
+        raise RuntimeError("WORKERS > 1 needs FSM_BACKEND=db: a draft must be visible to every worker")
+    ctx = multiprocessing.get_context("spawn")
+    procs: dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def spawn(index: int):
+        proc = ctx.Process(target=run_worker, args=(index,), name=f"worker-{index}")
+        proc.start()
+        procs[index] = proc
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for proc in procs.values():
+            proc.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(WORKERS):
+        spawn(index)
+    logging.info(f"Started {WORKERS} workers on port {PORT}")
+
+    while not stopping:
+        time.sleep(1)
+        for index, proc in list(procs.items()):
+            if not proc.is_alive() and not stopping:
+                logging.error(f"Worker {index} exited with code {proc.exitcode}, restarting")
+                spawn(index)
+    for proc in procs.values():
+        proc.join(timeout=30)
+
+
+def main():
+    if WORKERS > 1:
+        setup_logging()
+        run_supervisor()
+    else:
+        run_worker(0)
 
 
 if __name__ == "__main__":
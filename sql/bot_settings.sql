@@ -0,0 +1,6 @@
+-- Переключатели владельца (/sub, /notify): переживают перезапуск
+-- и одинаковы во всех воркерах при WORKERS > 1.
+create table if not exists bot_settings (
+    name  text primary key,
+    value jsonb not null
+);
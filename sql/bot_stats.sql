@@ -0,0 +1,23 @@
+-- Агрегаты для /stats и панели /start: одна строка JSON вместо всей таблицы files.
+create index if not exists files_downloads_idx on files (downloads desc nulls last);
+
+create or replace function bot_stats(top_n int default 5)
+returns json
+language sql
+stable
+as $$
+    select json_build_object(
+        'files',     (select count(*) from files),
+        'downloads', (select coalesce(sum(downloads), 0) from files),
+        'users',     (select count(*) from users),
+        'admins',    (select count(*) from admins),
+        'top', coalesce((
+            select json_agg(t) from (
+                select code, name, downloads, uploader_name, uploader_role
+                from files
+                order by downloads desc nulls last
+                limit top_n
+            ) t
+        ), '[]'::json)
+    );
+$$;
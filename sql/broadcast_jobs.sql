@@ -0,0 +1,30 @@
+-- Задания рассылки /send: переживают перезапуск и продолжаются с cursor.
+create table if not exists broadcast_jobs (
+    id                bigserial primary key,
+    from_chat_id      bigint not null,
+    message_id        bigint not null,
+    status_chat_id    bigint,
+    status_message_id bigint,
+    status            text   not null default 'running',  -- running | paused | cancelled | done
+    cursor            bigint not null default 0,          -- все user_id <= cursor обработаны
+    total             int    not null default 0,
+    sent              int    not null default 0,
+    failed            int    not null default 0,
+    blocked           int    not null default 0,
+    created_at        timestamptz not null default now()
+);
+
+create index if not exists broadcast_jobs_status_idx on broadcast_jobs (status);
+
+-- Исход по каждому получателю; пишется пачками
+create table if not exists broadcast_recipients (
+    job_id  bigint not null references broadcast_jobs (id) on delete cascade,
+    user_id bigint not null,
+    outcome text   not null,  -- sent | blocked | failed
+    primary key (job_id, user_id)
+);
+
+-- Аренда: воркер-владелец продлевает lease_until (unix-время) на чекпоинтах,
+-- задание с пустым owner или истёкшей арендой можно забрать условным UPDATE
+alter table broadcast_jobs add column if not exists owner       text;
+alter table broadcast_jobs add column if not exists lease_until double precision;
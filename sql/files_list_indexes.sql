@@ -0,0 +1,5 @@
+-- Индексы для keyset-пагинации /list и /myfiles по (created_at, code)
+create index if not exists files_created_code_idx
+    on files (created_at desc, code desc);
+create index if not exists files_uploader_created_code_idx
+    on files (uploaded_by, created_at desc, code desc);
@@ -0,0 +1,7 @@
+-- Состояния FSM (черновики /post, /send) для FSM_BACKEND=db.
+-- key — "fsm:<bot_id>:<chat_id>:<user_id>:<destiny>", пустое состояние — удалённая строка.
+create table if not exists fsm_states (
+    key   text primary key,
+    state text,
+    data  jsonb not null default '{}'::jsonb
+);
@@ -0,0 +1,11 @@
+-- Пакетное атомарное увеличение счётчика скачиваний.
+-- Вызывается ботом: POST /rest/v1/rpc/increment_downloads {"codes": [...], "deltas": [...]}
+create or replace function increment_downloads(codes text[], deltas int[])
+returns void
+language sql
+as $$
+    update files f
+    set downloads = coalesce(f.downloads, 0) + d.delta
+    from unnest(codes, deltas) as d(code, delta)
+    where f.code = d.code;
+$$;
@@ -0,0 +1,40 @@
+-- Серверный поиск для /find (SEARCH_BACKEND=server).
+-- Подстрока по name/caption через триграммные GIN-индексы, ранжирование
+-- как у индекса в боте: точное имя > начало имени > имя содержит > подпись.
+create extension if not exists pg_trgm;
+
+create index if not exists files_name_trgm_idx
+    on files using gin (lower(name) gin_trgm_ops);
+create index if not exists files_caption_trgm_idx
+    on files using gin (lower(coalesce(caption, '')) gin_trgm_ops);
+
+create or replace function search_files(q text, lim int default 20)
+returns json
+language sql
+stable
+as $$
+    with pattern as (
+        select '%' || replace(replace(replace(lower(q), '\', '\\'), '%', '\%'), '_', '\_') || '%' as p,
+               lower(q) as lq
+    ),
+    matched as (
+        select f.code, f.name, f.downloads, f.uploader_name, f.uploader_role,
+               lower(f.name) = pattern.lq                   as exact,
+               starts_with(lower(f.name), pattern.lq)       as prefix,
+               lower(f.name) like pattern.p                 as in_name
+        from files f, pattern
+        where lower(f.name) like pattern.p
+           or lower(coalesce(f.caption, '')) like pattern.p
+    )
+    select json_build_object(
+        'total', (select count(*) from matched),
+        'rows', coalesce((
+            select json_agg(t) from (
+                select code, name, downloads, uploader_name, uploader_role
+                from matched
+                order by exact desc, prefix desc, in_name desc, downloads desc nulls last
+                limit lim
+            ) t
+        ), '[]'::json)
+    );
+$$;
@@ -0,0 +1,16 @@
+-- Статистика по загрузившим для /adminstats: одна строка на uploaded_by.
+create index if not exists files_uploaded_by_idx on files (uploaded_by);
+
+create or replace function uploader_stats()
+returns table (uploaded_by bigint, uploader_name text, files bigint, downloads bigint)
+language sql
+stable
+as $$
+    select f.uploaded_by,
+           (array_agg(f.uploader_name order by f.created_at desc))[1],
+           count(*),
+           coalesce(sum(f.downloads), 0)
+    from files f
+    group by f.uploaded_by
+    order by count(*) desc;
+$$;
@@ -0,0 +1,11 @@
+-- Контекст автора апдейта за один запрос: строка админа и бан.
+create or replace function user_context(uid bigint)
+returns json
+language sql
+stable
+as $$
+    select json_build_object(
+        'admin',  (select row_to_json(a) from admins a where a.user_id = uid),
+        'banned', exists (select 1 from bans b where b.user_id = uid)
+    );
+$$;
@@ -0,0 +1,6 @@
+-- Отметка неактивных пользователей (заблокировали бота / удалили аккаунт).
+-- Бот ставит active = false по итогам рассылки и true при следующем /start.
+alter table users add column if not exists active boolean not null default true;
+
+create index if not exists users_active_user_id_idx
+    on users (user_id) where active;